@@ -0,0 +1,304 @@
+import heapq
+import os
+import pickle
+import time
+import numpy as np
+from typing import Callable
+from matplotlib import pyplot as plt
+import clearing_price
+from trajectory import ColumnWriter, read_table
+
+LOG_COLUMNS = ["TIME", "SEARCHING_BUYERS", "SEARCHING_SELLERS", "TOTAL_BUYERS", "TOTAL_SELLERS"]
+LOG_BUFFER_ROWS = 10000 # rows of results_log kept in memory before they are written to the output table
+
+class Pool:
+    """
+    The agents of one side of the market that are still searching: their product_values in ascending order and
+    their ids aligned with them, in preallocated buffers with free space on both ends like the book's SortedValues.
+    Positions are those of the live pool, so memory follows the agents still searching rather than every id ever
+    issued. An agent is found by binary search on its product_value, and as the book trades its strongest buyers
+    and weakest sellers, the agents that traded are a block at one end of the pool that is dropped in O(1).
+    """
+    def __init__(self, capacity=1024):
+        self.values = np.empty(capacity) # product_values of the agents, ascending in [start, stop)
+        self.ids = np.empty(capacity, dtype=np.int64) # id of the agent at each position
+        self.start = self.stop = capacity // 2
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def _recenter(self, capacity):
+        values, ids = self.values[self.start:self.stop].copy(), self.ids[self.start:self.stop].copy()
+        self.values, self.ids = np.empty(capacity), np.empty(capacity, dtype=np.int64)
+        self.start = (capacity - values.size) // 2
+        self.stop = self.start + values.size
+        self.values[self.start:self.stop], self.ids[self.start:self.stop] = values, ids
+
+    def find(self, agent_id, value):
+        # position of the agent in the pool, or -1 once it has left; agents of equal product_value are scanned
+        i = self.start + self.values[self.start:self.stop].searchsorted(value)
+        while i < self.stop and self.values[i] == value:
+            if self.ids[i] == agent_id: return i - self.start
+            i += 1
+        return -1
+
+    def insert(self, agent_id, value):
+        # one arrival after the agents of equal product_value, shifting the shorter side of the pool into its free space
+        i = self.start + self.values[self.start:self.stop].searchsorted(value, side="right")
+        if i - self.start < self.stop - i and self.start > 0:
+            self.values[self.start-1:i-1], self.ids[self.start-1:i-1] = self.values[self.start:i], self.ids[self.start:i]
+            self.start -= 1
+            self.values[i-1], self.ids[i-1] = value, agent_id
+        elif self.stop < self.values.size:
+            self.values[i+1:self.stop+1], self.ids[i+1:self.stop+1] = self.values[i:self.stop], self.ids[i:self.stop]
+            self.stop += 1
+            self.values[i], self.ids[i] = value, agent_id
+        else:
+            self._recenter(self.values.size if 4*len(self) < self.values.size else 2*self.values.size)
+            self.insert(agent_id, value)
+
+    def add(self, ids, values):
+        # merges a batch of arrivals after the agents of equal product_value, so ties stay in order of arrival; only the
+        # agents between the insertion points and the nearer end of the pool move, into the free space on that end
+        n = len(ids)
+        if n == 0: return
+        order = np.argsort(values, kind="stable")
+        values, ids = np.asarray(values, dtype=float)[order], np.asarray(ids)[order]
+        positions = np.searchsorted(self.values[self.start:self.stop], values, side="right")
+        if positions[-1] < len(self) - positions[0] and self.start >= n:
+            last = self.start + positions[-1]
+            self.values[self.start-n:last] = np.insert(self.values[self.start:last], positions, values)
+            self.ids[self.start-n:last] = np.insert(self.ids[self.start:last], positions, ids)
+            self.start -= n
+        elif self.stop + n <= self.values.size:
+            first = self.start + positions[0]
+            self.values[first:self.stop+n] = np.insert(self.values[first:self.stop], positions - positions[0], values)
+            self.ids[first:self.stop+n] = np.insert(self.ids[first:self.stop], positions - positions[0], ids)
+            self.stop += n
+        else:
+            self._recenter(max(self.values.size, 2*(len(self) + n)))
+            self.add(ids, values)
+
+    def remove_at(self, index):
+        # shifts the shorter side of the pool over the agent
+        i = self.start + index
+        if index < len(self) // 2:
+            self.values[self.start+1:i+1], self.ids[self.start+1:i+1] = self.values[self.start:i], self.ids[self.start:i]
+            self.start += 1
+        else:
+            self.values[i:self.stop-1], self.ids[i:self.stop-1] = self.values[i+1:self.stop], self.ids[i+1:self.stop]
+            self.stop -= 1
+
+    def remove_first(self, count):
+        self.start += count
+
+    def remove_last(self, count):
+        self.stop -= count
+
+class MarketSide:
+    # one side of the market: the searching pool, kept in the same order as the sorted book side
+    def __init__(self, book_side, mortality, trades_strongest_last):
+        """
+        :param trades_strongest_last: True for buyers, whose highest product_values trade; False for sellers, whose lowest do
+        """
+        self.pool = Pool()
+        self.book_side = book_side
+        self.trades_strongest_last = trades_strongest_last
+        self.hazard = -np.log(1 - mortality) # constant hazard rate matching the per-time-unit mortality
+        self.cumulative = 0
+
+    def arrive(self, arrival_times, values, deaths, side, rng):
+        ids = np.arange(self.cumulative, self.cumulative + len(values))
+        self.cumulative += len(values)
+        # a single event-driven arrival shifts the pool and the book by one slot; the arrivals of a clearing epoch are
+        # merged at once
+        if len(values) == 1:
+            self.pool.insert(int(ids[0]), values[0])
+            self.book_side.insert(values[0])
+        else:
+            self.pool.add(ids, values)
+            self.book_side.insert_many(values)
+        # each agent's lifetime is drawn once on arrival; a death only costs anything when it comes due. The product_value
+        # rides along so that the agent can be found in the pool
+        if self.hazard > 0:
+            for death_time, agent_id, value in zip((arrival_times + rng.exponential(size=len(values)) / self.hazard).tolist(), ids.tolist(), values.tolist()):
+                heapq.heappush(deaths, (death_time, side, agent_id, value))
+
+    def die(self, agent_id, value):
+        # agents that already traded have left the pool, so their pending deaths are ignored
+        index = self.pool.find(agent_id, value)
+        if index < 0: return False
+        # the pool and the book side hold the same product_values in the same order, so the agent's value is at the
+        # same position in both
+        self.pool.remove_at(index)
+        self.book_side.remove_at(index)
+        return True
+
+    def trade(self, values):
+        # the book popped the same block of product_values off its end; agents with equal product_values are
+        # interchangeable, so the pool's agents at that end are the ones that traded
+        if self.trades_strongest_last: self.pool.remove_last(len(values))
+        else: self.pool.remove_first(len(values))
+
+class ArrivalMarket:
+    def __init__(
+            self,
+            expected_buyer_arrivals: float,
+            expected_seller_arrivals: float,
+            buyer_mortality: float,
+            seller_mortality: float,
+            generate_buyer: Callable[[np.random.Generator, int], np.ndarray], # generates buyers' monetary valuations of the product
+            generate_seller: Callable[[np.random.Generator, int], np.ndarray]
+        ):
+        """
+        :param expected_buyer_arrivals: expected number of buyers arriving in one time unit
+        :param expected_seller_arrivals: expected number of sellers arriving in one time unit
+        :param buyer_mortality: expected number of buyers dying per buyer in one time unit
+        :param seller_mortality: expected number of sellers dying per seller in one time unit
+        :param generate_buyer: function (rng, n) returning the product_values of n random buyers
+        :param generate_seller: function (rng, n) returning the product_values of n random sellers
+        """
+        self.expected_buyer_arrivals = expected_buyer_arrivals
+        self.expected_seller_arrivals = expected_seller_arrivals
+        self.buyer_mortality = buyer_mortality
+        self.seller_mortality = seller_mortality
+        self.generate_buyer = generate_buyer
+        self.generate_seller = generate_seller
+
+    def run_simulation(self, time_horizon: float, seed=None, clearing_interval=None, verbose=True, output_dir=None, checkpoint_path=None, checkpoint_interval=1):
+        """
+        :param time_horizon: how many time units the simulation should last
+        :param seed: seed of the numpy.random.Generator driving arrivals, valuations and deaths
+        :param clearing_interval: None clears after every arrival; otherwise arrivals are batched and the market
+            clears once every clearing_interval time units
+        :param output_dir: directory the rows are streamed to as a trajectory table (columns LOG_COLUMNS) while the
+            simulation runs, instead of being kept in memory
+        :param checkpoint_path: file the simulation state is saved to every checkpoint_interval time units; if it
+            already exists the run resumes from it
+        :param checkpoint_interval: time units between checkpoints
+        :return: array of rows (time, number of buyers in market, number of sellers in market, total buyers ever, total sellers ever)
+        """
+        rng = np.random.default_rng(seed)
+        book = clearing_price.OrderBook()
+        self.buyers = MarketSide(book.buyers, self.buyer_mortality, trades_strongest_last=True)
+        self.sellers = MarketSide(book.sellers, self.seller_mortality, trades_strongest_last=False)
+        deaths = [] # priority queue of (death time, side, agent id, product_value)
+        next_arrivals = None # times of the next buyer and seller arrivals when clearing after every arrival
+        epoch = 0 # index of the next epoch when clearing every clearing_interval
+        next_checkpoint = checkpoint_interval
+        output = None if output_dir is None else ColumnWriter(output_dir)
+
+        results_log: list[list[float]] = list() # list of data (time, number of buyers in market, number of sellers in market, total buyers ever, total sellers ever) not yet written to output
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "rb") as file:
+                state = pickle.load(file)
+            # the book and the market sides are pickled together, so the sides still share the book's sorted values
+            rng, book, self.buyers, self.sellers = state["rng"], state["book"], state["buyers"], state["sellers"]
+            deaths, next_arrivals, epoch, next_checkpoint, results_log = state["deaths"], state["next_arrivals"], state["epoch"], state["next_checkpoint"], state["results_log"]
+            # rows written after the checkpoint are written again
+            if output is not None: output.truncate(state["output_rows"])
+        else:
+            results_log.append([0, 0, 0, 0, 0])
+            # a fresh run replaces the output of earlier runs
+            if output is not None: output.truncate(0)
+
+        start_time = time.time()
+        self.time_spent_in_clearing_price = 0
+
+        def write_log():
+            if output is None or not results_log: return
+            rows = np.array(results_log, dtype=float)
+            output.write({column: rows[:, i] for i, column in enumerate(LOG_COLUMNS)})
+            results_log.clear()
+
+        def save_checkpoint():
+            write_log()
+            if output is not None: output.flush()
+            state = {
+                "rng": rng,
+                "book": book,
+                "buyers": self.buyers,
+                "sellers": self.sellers,
+                "deaths": deaths,
+                "next_arrivals": next_arrivals,
+                "epoch": epoch,
+                "next_checkpoint": next_checkpoint,
+                "results_log": results_log,
+                "output_rows": None if output is None else len(output),
+            }
+            with open(checkpoint_path + ".tmp", "wb") as file:
+                pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+        def checkpoint(current_time):
+            nonlocal next_checkpoint
+            if checkpoint_path is None or current_time < next_checkpoint: return
+            next_checkpoint = (np.floor(current_time / checkpoint_interval) + 1) * checkpoint_interval
+            save_checkpoint()
+
+        def die_until(current_time):
+            while deaths and deaths[0][0] <= current_time:
+                _, side, agent_id, value = heapq.heappop(deaths)
+                (self.buyers if side == 0 else self.sellers).die(agent_id, value)
+
+        def clear_and_log(current_time):
+            # make all possible deals in current market at median clearing_price, removing successful agents
+            clearing_start_time = time.time()
+            result = book.clear()
+            self.time_spent_in_clearing_price += time.time() - clearing_start_time
+            if result:
+                _, traded_buyer_values, traded_seller_values = result
+                self.buyers.trade(traded_buyer_values)
+                self.sellers.trade(traded_seller_values)
+            results_log.append([current_time, len(self.buyers.pool), len(self.sellers.pool), self.buyers.cumulative, self.sellers.cumulative])
+            if len(results_log) >= LOG_BUFFER_ROWS: write_log()
+
+        if clearing_interval is None:
+            if next_arrivals is None: next_arrivals = [rng.exponential(1/self.expected_buyer_arrivals), rng.exponential(1/self.expected_seller_arrivals)]
+            while True:
+                # insert buyer or seller into pool when they arrive
+                current_time = min(time_horizon, *next_arrivals)
+                if current_time == time_horizon: break
+                die_until(current_time)
+                if current_time == next_arrivals[0]:
+                    self.buyers.arrive(np.array([current_time]), self.generate_buyer(rng, 1), deaths, 0, rng)
+                    next_arrivals[0] = current_time + rng.exponential(1/self.expected_buyer_arrivals)
+                else:
+                    self.sellers.arrive(np.array([current_time]), self.generate_seller(rng, 1), deaths, 1, rng)
+                    next_arrivals[1] = current_time + rng.exponential(1/self.expected_seller_arrivals)
+                clear_and_log(current_time)
+                checkpoint(current_time)
+        else:
+            epoch_starts = np.arange(0, time_horizon, clearing_interval)
+            while epoch < epoch_starts.size:
+                epoch_start = epoch_starts[epoch]
+                epoch_end = min(epoch_start + clearing_interval, time_horizon)
+                # the arrivals of a whole epoch are drawn at once and merged into the book before it clears
+                for side, index, expected_arrivals, generate in [(self.buyers, 0, self.expected_buyer_arrivals, self.generate_buyer), (self.sellers, 1, self.expected_seller_arrivals, self.generate_seller)]:
+                    n = rng.poisson(expected_arrivals * (epoch_end - epoch_start))
+                    side.arrive(np.sort(rng.uniform(epoch_start, epoch_end, n)), generate(rng, n), deaths, index, rng)
+                die_until(epoch_end)
+                clear_and_log(epoch_end)
+                epoch += 1
+                checkpoint(epoch_end)
+        if checkpoint_path is not None: save_checkpoint()
+
+        if verbose:
+            print("Seed:", seed)
+            print("Total loop time:", time.time() - start_time)
+            print("Total clearing price time:", self.time_spent_in_clearing_price)
+        if output is None: return np.array(results_log)
+        write_log()
+        output.close()
+        return read_table(output_dir).to_numpy()
+
+def plot_results(results_log, xlabel=None, ylabel=None, show_cumulative=True):
+    plt.plot(results_log[:,0], results_log[:,1], "r-", label="Searching Buyers")
+    plt.plot(results_log[:,0], results_log[:,2], "g-", label="Searching Sellers")
+    if show_cumulative:
+        plt.plot(results_log[:,0], results_log[:,3], "r--", label="Cumulative Buyers")
+        plt.plot(results_log[:,0], results_log[:,4], "g--", label="Cumulative Sellers")
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    plt.legend()
+    plt.show()
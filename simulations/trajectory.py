@@ -0,0 +1,71 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Append-only columnar tables for simulation output: a directory with schema.json and one raw binary file per
+# column. Rows are appended as the simulation runs and can be read at any time, also while it is still running.
+
+class ColumnWriter:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.files = None
+        self.dtypes = None
+        schema_path = os.path.join(directory, "schema.json")
+        if os.path.exists(schema_path):
+            with open(schema_path) as schema_file:
+                self.dtypes = {column: np.dtype(dtype) for column, dtype in json.load(schema_file).items()}
+
+    def __len__(self):
+        return table_rows(self.directory, self.dtypes) if self.dtypes else 0
+
+    def write(self, columns):
+        """
+        :param columns: dict of column -> array (or scalar for a single row); the first write fixes the schema
+        """
+        columns = {column: np.atleast_1d(values) for column, values in columns.items()}
+        if self.dtypes is None:
+            self.dtypes = {column: values.dtype for column, values in columns.items()}
+            with open(os.path.join(self.directory, "schema.json"), "w") as schema_file:
+                json.dump({column: dtype.str for column, dtype in self.dtypes.items()}, schema_file)
+        if self.files is None:
+            self.files = {column: open(column_path(self.directory, column), "ab") for column in self.dtypes}
+        for column, dtype in self.dtypes.items():
+            self.files[column].write(np.ascontiguousarray(columns[column], dtype=dtype).tobytes())
+
+    def flush(self):
+        for file in (self.files or {}).values(): file.flush()
+
+    def truncate(self, rows):
+        # drop everything after the first rows, e.g. rows written after the checkpoint a run resumes from
+        self.close()
+        for column, dtype in (self.dtypes or {}).items():
+            with open(column_path(self.directory, column), "ab") as file:
+                file.truncate(rows * dtype.itemsize)
+
+    def close(self):
+        for file in (self.files or {}).values(): file.close()
+        self.files = None
+
+def column_path(directory, column):
+    return os.path.join(directory, column + ".bin")
+
+def table_rows(directory, dtypes):
+    # rows written to every column; a row cut short by a crash is ignored
+    return min(os.path.getsize(column_path(directory, column)) // dtype.itemsize for column, dtype in dtypes.items())
+
+def read_table(directory, mmap=False):
+    """
+    :param directory: directory written by a ColumnWriter
+    :param mmap: memory-map the columns instead of reading them
+    :return: DataFrame of the complete rows written so far (empty if nothing has been written)
+    """
+    schema_path = os.path.join(directory, "schema.json")
+    if not os.path.exists(schema_path): return pd.DataFrame()
+    with open(schema_path) as schema_file:
+        dtypes = {column: np.dtype(dtype) for column, dtype in json.load(schema_file).items()}
+    rows = table_rows(directory, dtypes)
+    if rows == 0: return pd.DataFrame({column: np.empty(0, dtype) for column, dtype in dtypes.items()})
+    if mmap: return pd.DataFrame({column: np.memmap(column_path(directory, column), dtype, "r", shape=(rows,)) for column, dtype in dtypes.items()})
+    return pd.DataFrame({column: np.fromfile(column_path(directory, column), dtype, count=rows) for column, dtype in dtypes.items()})
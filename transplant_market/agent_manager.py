@@ -1,54 +1,181 @@
+import os
 import pandas as pd
 import numpy as np
-from ipumspy import readers, ddi
+import data_cache
+import agent_records
+import kidpan_reader
+
+# default locations of the licensed STAR and IPUMS extracts; pass other paths to AgentManager to override
+KIDPAN_PATH = "C:/Users/brand/Desktop/STAR_Delimited/Delimited Text File 202312/Kidney_ Pancreas_ Kidney-Pancreas/KIDPAN_DATA.DAT"
+NHIS_DDI_PATH = "C:/Users/brand/Desktop/STAR_Delimited/IPUMS Population Data/nhis_00001.dat/nhis_00001.xml"
+NHIS_DATA_PATH = "C:/Users/brand/Desktop/STAR_Delimited/IPUMS Population Data/nhis_00001.dat/nhis_00001.dat"
+KIDPAN_COLNAMES_PATH = kidpan_reader.KIDPAN_COLNAMES_PATH
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# bump these whenever the filtering/recoding in load_kidpan_data or load_nhis_data changes, invalidating the cache
+KIDPAN_CLEANING_VERSION = 2
+NHIS_CLEANING_VERSION = 1
+
+# KIDPAN columns read by load_kidpan_data, by their names in KIDPAN_DATA_colnames.csv; rows missing any of
+# KIDPAN_COLUMNS are dropped, rows missing the blood group or HLA typing are kept
+KIDPAN_COLUMNS = ["WL_ORG", "NUM_PREV_TX", "GFR", "GENDER", "EDUCATION", "DIAB", "INIT_AGE", "ETHCAT", "WORK_INCOME_TCR", "DON_TY"]
+KIDPAN_TYPING_COLUMNS = ["ABO"] + agent_records.HLA_COLUMNS
+
+# log-hazard coefficients of the NHIS all-cause mortality model used by giver_mortality
+GIVER_MORTALITY_BETA_MALE = np.array([0.02, 0.09, -0.01, 0.05, -0.22, -0.18, -0.12, 0.03, 0.07, 0.02, -0.04, -0.06, -0.05, -0.12, -0.19, 0.05, 0.06, 0.15, 0.21, 0.31, 0.36, 0.43, 0.32, 0.49, 0.59, 0.68, 0.55, 0.68, 0.49, 0.55, 0.74, 0.78, 0.87, 0.92, 0.71, 0.8, 0.92, 1.22, 1, 0.71, 0.77, 0.99, 1.13, 1.29, 1.31, 1.25, 0.36, -0.11, -0.23, -0.25, -0.31, -0.31, -0.17, -0.19, -0.22, -0.18, -0.06, -0.03, 0.01, -0.05, 0.08, 0.17, 0.36, 0.7, 1.25, 0.52, 0.22, 0.22, 0.19, 0.31, 0.05, 0.47, -0.03, 0.08])
+GIVER_MORTALITY_BETA_FEMALE = np.array([0.01, 0.07, -0.01, -0.02, -0.19, -0.28, -0.24, 0.14, 0.12, 0.05, 0.04, 0.02, 0.03, -0.01, -0.05, 0.09, 0.04, 0.21, 0.35, 0.42, 0.34, 0.55, 0.28, 0.44, 0.52, 0.77, 0.58, 0.99, 0.34, 0.58, 0.71, 0.81, 0.54, 0.64, 0.56, 0.89, 1.03, 1.07, 1.02, 0.44, 0.86, 1.12, 1.23, 1.39, 1.45, 1.53, 0.4, -0.11, -0.24, -0.26, -0.31, -0.27, -0.18, -0.18, -0.11, -0.06, 0.15, 0, 0.05, 0.01, 0.37, 0.12, 0.34, 0.67, 1.1, 0.52, 0.15, 0.12, 0.1, 0.27, 0.2, 0.62, -0.09, 0.05])
+
+# positions of the covariates that are ever non-zero: BMI (cubic), race, education, diabetes and height do not
+# change as an agent ages, the agent's age does
+GIVER_STATIC_COVARIATES = [0, 1, 2, 3, 4, 9, 10, 11, 12, 13, 14, 71, 73]
+GIVER_AGE_COVARIATE = 72
+
+# columns each batch valuation needs from a cohort
+RECIPIENT_COLUMNS = ["AGE", "IS_MALE", "IS_WHITE", "IS_BLACK", "IS_HISPANIC", "EDUC", "WORK_INCOME_TCR", "GFR", "HAS_DIABETES", "PRIOR_TRANSPLANT"]
+GIVER_COLUMNS = ["AGE", "IS_MALE", "IS_WHITE", "IS_BLACK", "IS_HISPANIC", "EDUC", "HAS_DIABETES", "BMI", "HEIGHT", "MORTALITY_PREDICTOR"]
+
+class AgeGrid:
+    """
+    Ages of a cohort over the shared grid of future times used by the batch valuation (agents x time).
+    AgeTable evaluates it by gathering rows of a table precomputed for that grid.
+    """
+    def __init__(self, ages, future_time):
+        self.ages = np.asarray(ages, dtype=float).reshape(-1, 1)
+        self.future_time = future_time
+        self.key = future_time.tobytes()
+
+class AgeTable:
+    """
+    A function of age tabulated once over the shared valuation grid: one row per starting age on a regular grid,
+    one column per future time. Batch valuations gather rows instead of re-evaluating the function for every
+    agent x time entry; pointwise calls evaluate the closed form, which is cheaper than interpolating.
+    """
+    def __init__(self, fxn, max_age=200, step=1/12):
+        self.fxn = fxn
+        self.step = step
+        self.ages = np.arange(0, max_age + 2*step, step)
+        self.grid_tables = {}
+
+    def __call__(self, age):
+        if isinstance(age, AgeGrid): return self.over_grid(age)
+        return self.fxn(age)
+
+    def over_grid(self, age_grid):
+        # one row per tabulated starting age, one column per future time of the grid
+        if age_grid.key not in self.grid_tables:
+            self.grid_tables[age_grid.key] = self.fxn(self.ages[:, None] + age_grid.future_time)
+        table = self.grid_tables[age_grid.key]
+        position = np.clip(age_grid.ages / self.step, 0, self.ages.size - 2)
+        i = position[:, 0].astype(int)
+        fraction = position - i[:, None]
+        # ages drawn from the data and aged in whole time steps sit exactly on the table
+        if not np.any(fraction): return table[i]
+        return table[i] * (1 - fraction) + table[i+1] * fraction
+
+# age-dependent baselines of the income and mortality models
+GIVER_INCOME_BY_AGE = AgeTable(lambda age : -12720 + 1812.2356*age - 17.3636*age**2)
+GIVER_BASELINE_HAZARD = AgeTable(lambda age : 0.000034 * np.exp(0.092899 * age) + 0.000915)
+DIALYSIS_BASELINE_HAZARD_WHITE = AgeTable(lambda age : 0.030377 * np.exp(0.035875 * age) + 0.020246)
+DIALYSIS_BASELINE_HAZARD_BLACK = AgeTable(lambda age : 0.006207 * np.exp(0.052413 * age) + 0.061768)
+DIALYSIS_BASELINE_HAZARD_HISPANIC = AgeTable(lambda age : 0.015619 * np.exp(0.042351 * age) + 0.005365)
+TRANSPLANT_BASELINE_HAZARD = AgeTable(lambda age : 0.000022685 * np.exp(0.083531722 * age))
+
+def hyperbolic_discounting(future_time, annual_discount=0.98):
+    return 1/(1 + np.log(1/annual_discount) * future_time)
+
+# subintervals of the scipy.integrate.quad reference of validate_valuations, above quad's default of 50 so that
+# the reference resolves the steps of the income and hazard tables over the 100 year horizon
+QUAD_LIMIT = 200
+
+def quadrature_grid(max_time, panels=25, order=8):
+    # composite Gauss-Legendre nodes and weights on [0, max_time], shared by every agent in a cohort
+    nodes, weights = np.polynomial.legendre.leggauss(order)
+    edges = np.linspace(0, max_time, panels+1)
+    midpoints = ((edges[:-1] + edges[1:]) / 2)[:, None]
+    half_widths = (np.diff(edges) / 2)[:, None]
+    return (midpoints + half_widths*nodes).ravel(), (half_widths*weights).ravel()
+
+def clean_kidpan_chunk(chunk):
+    # restrict to non-foreign donors, kidney-only donations, and white/black/hispanic race only
+    chunk = chunk[chunk["WL_ORG"] == "KI"]
+    chunk = chunk[chunk["DON_TY"] != "F"]
+    chunk = chunk[(chunk["ETHCAT"] == 1) | (chunk["ETHCAT"] == 2) | (chunk["ETHCAT"] == 4)]
+    # find na values and then drop them
+    chunk = chunk.replace({
+        "EDUCATION" : {996 : np.nan, 998 : np.nan},
+        "DIAB" : {5 : np.nan, 998 : np.nan,},
+        "WORK_INCOME_TCR" : {"U" : np.nan},
+        **{hla_column : {97 : np.nan, 99 : np.nan} for hla_column in agent_records.HLA_COLUMNS}
+    })
+    return chunk.dropna(subset=KIDPAN_COLUMNS)
 
 class AgentManager:
 
-    def __init__(self):
+    def __init__(self, kidpan_path=KIDPAN_PATH, nhis_ddi_path=NHIS_DDI_PATH, nhis_data_path=NHIS_DATA_PATH, cache_dir=CACHE_DIR, kidpan_colnames_path=KIDPAN_COLNAMES_PATH):
+        """
+        :param kidpan_path: STAR tab-delimited KIDPAN_DATA.DAT file
+        :param nhis_ddi_path: IPUMS NHIS DDI codebook (.xml)
+        :param nhis_data_path: IPUMS NHIS fixed-width extract (.dat)
+        :param cache_dir: directory for the cleaned tables; None disables caching
+        :param kidpan_colnames_path: KIDPAN codebook giving the position and type of each column
+        """
+        self.kidpan_path = kidpan_path
+        self.kidpan_colnames_path = kidpan_colnames_path
+        self.nhis_ddi_path = nhis_ddi_path
+        self.nhis_data_path = nhis_data_path
+        self.cache_dir = cache_dir
         self.init_kidpan_data()
         self.init_nhis_data()
+        self.init_column_arrays()
+        self.init_model_tables()
+
+    @classmethod
+    def from_tables(cls, kidpan_data, nhis_data):
+        # builds a manager around already-cleaned tables, e.g. synthetic populations, without touching the data files
+        am = cls.__new__(cls)
+        am.kidpan_path = am.kidpan_colnames_path = am.nhis_ddi_path = am.nhis_data_path = am.cache_dir = None
+        am.kidpan_data = kidpan_data
+        am.nhis_data = nhis_data
+        am.init_column_arrays()
+        am.init_model_tables()
+        return am
+
+    def init_column_arrays(self):
+        # NumPy views of the cleaned tables so that batched draws index arrays rather than pandas rows
+        self.kidpan_arrays = {column: self.kidpan_data[column].to_numpy() for column in self.kidpan_data.columns}
+        self.kidpan_arrays["AGE"] = self.kidpan_arrays["INIT_AGE"]
+        self.nhis_arrays = {column: self.nhis_data[column].to_numpy() for column in self.nhis_data.columns}
+        # compact RACE/DIABETIC (and BLOOD_TYPE/HLA where typed) codes carried into the AgentStores
+        self.kidpan_arrays.update(agent_records.compact_codes(self.kidpan_data))
+        self.nhis_arrays.update(agent_records.compact_codes(self.nhis_data))
+        # identifies the tables agents are drawn from, so that valuations cached under a SOURCE_ROW of one manager
+        # are never served for another (see valuation_cache.ValuationCache)
+        self.fingerprint = (data_cache.table_fingerprint(self.kidpan_data), data_cache.table_fingerprint(self.nhis_data))
+
+    def init_model_tables(self):
+        # population moments used to standardize giver covariates, and each NHIS row's age-independent log-hazard
+        self.nhis_moments = {column: (np.mean(self.nhis_data[column]), np.std(self.nhis_data[column])) for column in ["BMI", "AGE", "HEIGHT"]}
+        self.nhis_arrays["MORTALITY_PREDICTOR"] = self.giver_static_predictor(self.nhis_arrays)
 
     def init_kidpan_data(self):
-        # download the data
-        kidpan_data_columns = {
-            "WL_ORG" : 0,
-            "NUM_PREV_TX" : 2,
-            "GFR" : 7,
-            "GENDER" : 24,
-            "EDUCATION" : 33,
-            "DIAB" : 37,
-            "INIT_AGE" : 54,
-            "ETHCAT" : 63,
-            "WORK_INCOME_TCR" : 99,
-            "DON_TY" : 194,
-        }
-        self.kidpan_data = pd.read_csv(
-            "C:/Users/brand/Desktop/STAR_Delimited/Delimited Text File 202312/Kidney_ Pancreas_ Kidney-Pancreas/KIDPAN_DATA.DAT",
-            sep="\t",
-            usecols=list(kidpan_data_columns.values())
-        )
-        self.kidpan_data.columns = list(kidpan_data_columns.keys())
-        # restrict to non-foreign donors, kidney-only donations, and white/black/hispanic race only
-        self.kidpan_data = self.kidpan_data[self.kidpan_data["WL_ORG"] == "KI"]
-        self.kidpan_data = self.kidpan_data[self.kidpan_data["DON_TY"] != "F"]
-        self.kidpan_data = self.kidpan_data[
-            (self.kidpan_data["ETHCAT"] == 1) | (self.kidpan_data["ETHCAT"] == 2) | (self.kidpan_data["ETHCAT"] == 4)
-        ]
-        # clean up data
-        self.kidpan_data = self.kidpan_data.replace(".", np.nan)
-        for numeric_column in ["INIT_AGE", "GFR", "NUM_PREV_TX", "DIAB", "EDUCATION"]:
-            self.kidpan_data[numeric_column] = self.kidpan_data[numeric_column].astype(float)
-        # find na values and then drop them
-        self.kidpan_data = self.kidpan_data.replace({
-            "ETHCAT" : {998 : np.nan},
-            "ETHCAT_DON" : {998 : np.nan},
-            "EDUCATION" : {996 : np.nan, 998 : np.nan},
-            "EDUCATION_DON" : {996 : np.nan, 998 : np.nan,},
-            "PRI_PAYMENT_TCR_KI" : {15 : np.nan},
-            "DIAB" : {5 : np.nan, 998 : np.nan,},
-            "WORK_INCOME_TCR" : {"U" : np.nan}
-        })
-        self.kidpan_data = self.kidpan_data.dropna()
+        if self.cache_dir is None: return self.load_kidpan_data()
+        key = data_cache.source_key([self.kidpan_path, self.kidpan_colnames_path], KIDPAN_CLEANING_VERSION)
+        self.kidpan_data = data_cache.load_table(self.cache_dir, "kidpan_data", key)
+        if self.kidpan_data is None:
+            self.load_kidpan_data()
+            data_cache.save_table(self.cache_dir, "kidpan_data", key, self.kidpan_data)
+
+    def init_nhis_data(self):
+        if self.cache_dir is None: return self.load_nhis_data()
+        key = data_cache.source_key([self.nhis_ddi_path, self.nhis_data_path], NHIS_CLEANING_VERSION)
+        self.nhis_data = data_cache.load_table(self.cache_dir, "nhis_data", key)
+        if self.nhis_data is None:
+            self.load_nhis_data()
+            data_cache.save_table(self.cache_dir, "nhis_data", key, self.nhis_data)
+
+    def load_kidpan_data(self):
+        # stream the columns we need, keeping only the rows that survive clean_kidpan_chunk
+        self.kidpan_data = kidpan_reader.read_kidpan(self.kidpan_path, KIDPAN_COLUMNS + KIDPAN_TYPING_COLUMNS, clean_kidpan_chunk, colnames_path=self.kidpan_colnames_path)
         # create dummy variables
         self.kidpan_data["IS_MALE"] = (self.kidpan_data["ETHCAT"] == 1)
         self.kidpan_data["IS_WHITE"] = (self.kidpan_data["ETHCAT"] == 1)
@@ -58,11 +185,14 @@ class AgentManager:
         self.kidpan_data["PRIOR_TRANSPLANT"] = (self.kidpan_data["NUM_PREV_TX"] > 0)
         self.kidpan_data["WORK_INCOME_TCR"] = (self.kidpan_data["WORK_INCOME_TCR"] == "Y")
 
-    def init_nhis_data(self):
+    def load_nhis_data(self):
+        # ipumspy is only needed when the cache is cold
+        from ipumspy import readers
+
         # download the data
         self.nhis_data = readers.read_microdata(
-            ddi=readers.read_ipums_ddi("C:/Users/brand/Desktop/STAR_Delimited/IPUMS Population Data/nhis_00001.dat/nhis_00001.xml"),
-            filename="C:/Users/brand/Desktop/STAR_Delimited/IPUMS Population Data/nhis_00001.dat/nhis_00001.dat"
+            ddi=readers.read_ipums_ddi(self.nhis_ddi_path),
+            filename=self.nhis_data_path
         )
         # restrict to 2019 data, people over 18 and without diabetes, and white/black/hispanic race only
         self.nhis_data = self.nhis_data[self.nhis_data["YEAR"] == 2019]
@@ -98,33 +228,55 @@ class AgentManager:
 
     def generate_giver(self):
         return self.nhis_data.iloc[np.random.randint(0,self.nhis_data.shape[0])]
+
+    def generate_recipients(self, n, rng=None):
+        """
+        :param n: number of recipients to draw (with replacement) from kidpan_data
+        :param rng: numpy.random.Generator to draw with
+        :return: struct-of-arrays cohort, a dict of column -> array of length n; SOURCE_ROW holds the drawn rows
+        """
+        if rng is None: rng = np.random.default_rng()
+        rows = rng.integers(0, self.kidpan_data.shape[0], size=n)
+        cohort = {column: values[rows] for column, values in self.kidpan_arrays.items()}
+        cohort["SOURCE_ROW"] = rows
+        return cohort
+
+    def generate_givers(self, n, rng=None):
+        """
+        :param n: number of givers to draw (with replacement) from nhis_data
+        :param rng: numpy.random.Generator to draw with
+        :return: struct-of-arrays cohort, a dict of column -> array of length n; SOURCE_ROW holds the drawn rows
+        """
+        if rng is None: rng = np.random.default_rng()
+        rows = rng.integers(0, self.nhis_data.shape[0], size=n)
+        cohort = {column: values[rows] for column, values in self.nhis_arrays.items()}
+        cohort["SOURCE_ROW"] = rows
+        return cohort
     
     def giver_income(self, agent, age):
-        return -12720 + 1812.2356*age - 17.3636*age**2 + 3.08*10**(-11)*agent["IS_MALE"] + 3630.4875*agent["IS_WHITE"] - 11990*agent["IS_BLACK"] - 8098.4875*agent["IS_HISPANIC"] + 33090*(agent["EDUC"] >= 300)
-    
-    def giver_mortality(self, agent, age):
-        bmi_std = (agent["BMI"] - np.mean(self.nhis_data["BMI"]))/np.std(self.nhis_data["BMI"])
-        covariates = []
-        covariates += [bmi_std, bmi_std**2, bmi_std**3]
-        covariates += [agent["IS_BLACK"], agent["IS_HISPANIC"], 0, 0, 0, 0]
-        try:
-            covariates += [agent["EDUC"] == 103, agent["EDUC"] == 201, agent["EDUC"] == 302, agent["EDUC"] == 301, agent["EDUC"] == 400, (agent["EDUC"] >= 500) & (agent["EDUC"] <= 505), 0]
-        except:
-            covariates += [0, 0, 0, 1, 0, 0, 0]
-        covariates += [0] * 31
-        covariates += [0] * 6
-        covariates += [0] * 8
-        covariates += [0] * 5
-        covariates += [0] * 5
-        covariates += [agent["HAS_DIABETES"]]
-        covariates += [(agent["AGE"] - np.mean(self.nhis_data["AGE"]))/np.std(self.nhis_data["AGE"])]
-        covariates += [(agent["HEIGHT"] - np.mean(self.nhis_data["HEIGHT"]))/np.std(self.nhis_data["HEIGHT"])]
-        if agent["IS_MALE"]:
-            beta = np.array([0.02, 0.09, -0.01, 0.05, -0.22, -0.18, -0.12, 0.03, 0.07, 0.02, -0.04, -0.06, -0.05, -0.12, -0.19, 0.05, 0.06, 0.15, 0.21, 0.31, 0.36, 0.43, 0.32, 0.49, 0.59, 0.68, 0.55, 0.68, 0.49, 0.55, 0.74, 0.78, 0.87, 0.92, 0.71, 0.8, 0.92, 1.22, 1, 0.71, 0.77, 0.99, 1.13, 1.29, 1.31, 1.25, 0.36, -0.11, -0.23, -0.25, -0.31, -0.31, -0.17, -0.19, -0.22, -0.18, -0.06, -0.03, 0.01, -0.05, 0.08, 0.17, 0.36, 0.7, 1.25, 0.52, 0.22, 0.22, 0.19, 0.31, 0.05, 0.47, -0.03, 0.08])
+        return GIVER_INCOME_BY_AGE(age) + 3.08*10**(-11)*agent["IS_MALE"] + 3630.4875*agent["IS_WHITE"] - 11990*agent["IS_BLACK"] - 8098.4875*agent["IS_HISPANIC"] + 33090*(agent["EDUC"] >= 300)
+
+    def giver_static_predictor(self, agent):
+        # the part of giver_mortality's log-hazard that does not change as the agent ages
+        bmi_std = (agent["BMI"] - self.nhis_moments["BMI"][0])/self.nhis_moments["BMI"][1]
+        height_std = (agent["HEIGHT"] - self.nhis_moments["HEIGHT"][0])/self.nhis_moments["HEIGHT"][1]
+        if "EDUC" in agent:
+            education = [agent["EDUC"] == 103, agent["EDUC"] == 201, agent["EDUC"] == 302, agent["EDUC"] == 301, agent["EDUC"] == 400, (agent["EDUC"] >= 500) & (agent["EDUC"] <= 505)]
         else:
-            beta = np.array([0.01, 0.07, -0.01, -0.02, -0.19, -0.28, -0.24, 0.14, 0.12, 0.05, 0.04, 0.02, 0.03, -0.01, -0.05, 0.09, 0.04, 0.21, 0.35, 0.42, 0.34, 0.55, 0.28, 0.44, 0.52, 0.77, 0.58, 0.99, 0.34, 0.58, 0.71, 0.81, 0.54, 0.64, 0.56, 0.89, 1.03, 1.07, 1.02, 0.44, 0.86, 1.12, 1.23, 1.39, 1.45, 1.53, 0.4, -0.11, -0.24, -0.26, -0.31, -0.27, -0.18, -0.18, -0.11, -0.06, 0.15, 0, 0.05, 0.01, 0.37, 0.12, 0.34, 0.67, 1.1, 0.52, 0.15, 0.12, 0.1, 0.27, 0.2, 0.62, -0.09, 0.05])
-        mort = (0.000034 * np.exp(0.092899 * age) + 0.000915) * np.exp(beta @ np.array(covariates))
-        return np.clip(mort, a_max=1)
+            education = [0, 0, 0, 1, 0, 0]
+        covariates = [bmi_std, bmi_std**2, bmi_std**3, agent["IS_BLACK"], agent["IS_HISPANIC"]] + education + [agent["HAS_DIABETES"], height_std]
+        male = sum(beta * covariate for beta, covariate in zip(GIVER_MORTALITY_BETA_MALE[GIVER_STATIC_COVARIATES], covariates))
+        female = sum(beta * covariate for beta, covariate in zip(GIVER_MORTALITY_BETA_FEMALE[GIVER_STATIC_COVARIATES], covariates))
+        return np.where(agent["IS_MALE"], male, female)
+
+    def giver_mortality(self, agent, age):
+        # agents drawn with generate_givers carry their static predictor; anything else has it computed here
+        if "MORTALITY_PREDICTOR" in agent: static_predictor = agent["MORTALITY_PREDICTOR"]
+        else: static_predictor = self.giver_static_predictor(agent)
+        age_std = (agent["AGE"] - self.nhis_moments["AGE"][0])/self.nhis_moments["AGE"][1]
+        age_predictor = np.where(agent["IS_MALE"], GIVER_MORTALITY_BETA_MALE[GIVER_AGE_COVARIATE], GIVER_MORTALITY_BETA_FEMALE[GIVER_AGE_COVARIATE]) * age_std
+        mort = GIVER_BASELINE_HAZARD(age) * np.exp(static_predictor + age_predictor)
+        return np.clip(mort, a_min=None, a_max=1)
 
     def recipient_income_dialysis(self, agent, age):
         return 0.23 * self.giver_income(agent, age) + 0.77 * 12140
@@ -135,12 +287,127 @@ class AgentManager:
 
     def receipient_mortality_dialysis(self, agent, age):
         beta = 0.0064 * agent["GFR"] + 0.0362 * agent["HAS_DIABETES"]
-        if agent["IS_WHITE"]: h = 0.030377 * np.exp(0.035875 * age) + 0.020246
-        elif agent["IS_BLACK"]: h =  0.006207 * np.exp(0.052413 * age) + 0.061768
-        elif agent["IS_HISPANIC"]: h =  0.015619 * np.exp(0.042351 * age) + 0.005365
+        h = np.where(agent["IS_WHITE"], DIALYSIS_BASELINE_HAZARD_WHITE(age),
+            np.where(agent["IS_BLACK"], DIALYSIS_BASELINE_HAZARD_BLACK(age),
+            np.where(agent["IS_HISPANIC"], DIALYSIS_BASELINE_HAZARD_HISPANIC(age), np.nan)))
         mort = h * (1 - beta) + beta
-        return np.clip(mort, a_max=1)
+        return np.clip(mort, a_min=None, a_max=1)
     
     def recipient_mortality_transplant(self, agent, waitlist_time, age):
-        mort = 0.000022685 * np.exp(0.083531722 * age) + 0.000000229*waitlist_time + 0.000452195*agent["PRIOR_TRANSPLANT"] + 0.000824622*agent["HAS_DIABETES"] - 0.000020527*agent["GFR"] + 0.000093482*agent["IS_WHITE"]
-        return np.clip(mort, a_max=1)
\ No newline at end of file
+        mort = TRANSPLANT_BASELINE_HAZARD(age) + 0.000000229*waitlist_time + 0.000452195*agent["PRIOR_TRANSPLANT"] + 0.000824622*agent["HAS_DIABETES"] - 0.000020527*agent["GFR"] + 0.000093482*agent["IS_WHITE"]
+        return np.clip(mort, a_min=None, a_max=1)
+
+    # batch valuation: every agent in a cohort is evaluated on one shared quadrature grid (agents x time)
+
+    def _cohort(self, agents, columns):
+        cohort = {}
+        for column in columns:
+            if column in agents: cohort[column] = np.asarray(agents[column], dtype=float)
+            elif column == "AGE": cohort[column] = np.asarray(agents["INIT_AGE"], dtype=float)
+            # KIDPAN EDUCATION >= 4 (attended college) maps onto the NHIS EDUC >= 300 threshold used by giver_income
+            elif column == "EDUC": cohort[column] = np.where(np.asarray(agents["EDUCATION"], dtype=float) >= 4, 300., 0.)
+            elif column == "MORTALITY_PREDICTOR": cohort[column] = self.giver_static_predictor(cohort)
+            else: raise KeyError(column)
+        return cohort
+
+    def value_recipients(self, agents, waitlist_time=0, time_discounting=hyperbolic_discounting, max_discounted_time=100, chunk_size=4096):
+        """
+        :param agents: DataFrame (or dict of columns) of recipients, e.g. rows of kidpan_data
+        :param waitlist_time: years each recipient has waited, scalar or one per agent
+        :param time_discounting: vectorized discount factor as a function of future time
+        :param max_discounted_time: upper limit of the valuation integral in years
+        :param chunk_size: agents evaluated together, bounding the agents x time working arrays
+        :return: discounted income conditional on transplant minus conditional on dialysis, one per agent
+        """
+        cohort = self._cohort(agents, RECIPIENT_COLUMNS)
+        n = cohort["AGE"].size
+        waitlist_time = np.broadcast_to(np.asarray(waitlist_time, dtype=float), (n,))
+        future_time, weights = quadrature_grid(max_discounted_time)
+        discounted_weights = weights * time_discounting(future_time)
+        valuations = np.empty(n)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            agent = {column: values[start:stop, None] for column, values in cohort.items()}
+            age = AgeGrid(agent["AGE"], future_time)
+            transplant = self.recipient_income_transplant(agent, future_time, age) * self.recipient_mortality_transplant(agent, waitlist_time[start:stop, None], age)
+            dialysis = self.recipient_income_dialysis(agent, age) * self.receipient_mortality_dialysis(agent, age)
+            valuations[start:stop] = (transplant - dialysis) @ discounted_weights
+        return valuations
+
+    def value_givers(self, agents, transplant_income_fxn=lambda inc : inc, transplant_mortality_fxn=lambda mort : mort, time_discounting=hyperbolic_discounting, max_discounted_time=100, chunk_size=4096):
+        """
+        :param agents: DataFrame (or dict of columns) of givers, e.g. rows of nhis_data
+        :param transplant_income_fxn: vectorized adjustment of income after giving a kidney
+        :param transplant_mortality_fxn: vectorized adjustment of mortality after giving a kidney
+        :param time_discounting: vectorized discount factor as a function of future time
+        :param max_discounted_time: upper limit of the valuation integral in years
+        :param chunk_size: agents evaluated together, bounding the agents x time working arrays
+        :return: discounted income conditional on giving minus conditional on not giving, one per agent
+        """
+        cohort = self._cohort(agents, GIVER_COLUMNS)
+        n = cohort["AGE"].size
+        future_time, weights = quadrature_grid(max_discounted_time)
+        discounted_weights = weights * time_discounting(future_time)
+        valuations = np.empty(n)
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            agent = {column: values[start:stop, None] for column, values in cohort.items()}
+            age = AgeGrid(agent["AGE"], future_time)
+            income = self.giver_income(agent, age)
+            mort = self.giver_mortality(agent, age)
+            valuations[start:stop] = (transplant_income_fxn(income) * transplant_mortality_fxn(mort) - income * mort) @ discounted_weights
+        return valuations
+
+    def validate_valuations(self, agents, kind="recipient", sample_size=20, rtol=1e-3, atol=1e-2, seed=None, **valuation_kwargs):
+        """
+        Checks the batch valuation against per-agent scipy.integrate.quad on a random sample of the cohort.
+        :param kind: "recipient" (value_recipients) or "giver" (value_givers); givers are checked with a 10% income
+            loss and a 50% higher hazard after transplant unless transplant functions are given
+        :return: largest relative error in the sample; raises ValueError if any agent is outside tolerance
+        """
+        import scipy as sp
+
+        if kind == "giver":
+            # with the identity transplant functions both integrals cancel, so the check would compare 0 with 0
+            valuation_kwargs.setdefault("transplant_income_fxn", lambda inc : 0.9 * inc)
+            valuation_kwargs.setdefault("transplant_mortality_fxn", lambda mort : 1 - (1 - mort)**1.5)
+        if kind == "recipient":
+            cohort = self._cohort(agents, RECIPIENT_COLUMNS)
+            batch = self.value_recipients(agents, **valuation_kwargs)
+        elif kind == "giver":
+            cohort = self._cohort(agents, GIVER_COLUMNS)
+            batch = self.value_givers(agents, **valuation_kwargs)
+        else:
+            raise ValueError("Invalid kind")
+        n = cohort["AGE"].size
+        time_discounting = valuation_kwargs.get("time_discounting", hyperbolic_discounting)
+        max_discounted_time = valuation_kwargs.get("max_discounted_time", 100)
+        waitlist_time = np.broadcast_to(np.asarray(valuation_kwargs.get("waitlist_time", 0), dtype=float), (n,))
+        transplant_income_fxn = valuation_kwargs.get("transplant_income_fxn", lambda inc : inc)
+        transplant_mortality_fxn = valuation_kwargs.get("transplant_mortality_fxn", lambda mort : mort)
+
+        sample = np.random.default_rng(seed).choice(n, size=min(sample_size, n), replace=False)
+        reference = np.empty(sample.size)
+        for i, agent_index in enumerate(sample):
+            agent = pd.Series({column: values[agent_index] for column, values in cohort.items()})
+            if kind == "recipient":
+                reference[i] = sp.integrate.quad(
+                    lambda future_time : self.recipient_income_transplant(agent, future_time, agent["AGE"]+future_time) * self.recipient_mortality_transplant(agent, waitlist_time[agent_index], agent["AGE"]+future_time) * time_discounting(future_time),
+                    0, max_discounted_time, limit=QUAD_LIMIT
+                )[0] - sp.integrate.quad(
+                    lambda future_time : self.recipient_income_dialysis(agent, agent["AGE"]+future_time) * self.receipient_mortality_dialysis(agent, agent["AGE"]+future_time) * time_discounting(future_time),
+                    0, max_discounted_time, limit=QUAD_LIMIT
+                )[0]
+            else:
+                reference[i] = sp.integrate.quad(
+                    lambda future_time : transplant_income_fxn(self.giver_income(agent, agent["AGE"]+future_time)) * transplant_mortality_fxn(self.giver_mortality(agent, agent["AGE"]+future_time)) * time_discounting(future_time),
+                    0, max_discounted_time, limit=QUAD_LIMIT
+                )[0] - sp.integrate.quad(
+                    lambda future_time : self.giver_income(agent, agent["AGE"]+future_time) * self.giver_mortality(agent, agent["AGE"]+future_time) * time_discounting(future_time),
+                    0, max_discounted_time, limit=QUAD_LIMIT
+                )[0]
+
+        error = np.abs(batch[sample] - reference)
+        if np.any(error > atol + rtol * np.abs(reference)):
+            raise ValueError(f"Batch valuation differs from quad by up to {np.max(error)}")
+        return np.max(error / np.maximum(np.abs(reference), atol))
@@ -0,0 +1,76 @@
+import numpy as np
+
+# Compact encodings of agent characteristics, mirroring the enums of simulations/agent.py. They turn the
+# KIDPAN/NHIS rows drawn by AgentManager into int8 codes, integer day offsets and packed HLA typings.
+
+DAYS_PER_YEAR = 365.25
+NEVER = np.iinfo(np.int32).min # day offset of an event that has not happened
+
+# RACE codes (KIDPAN ETHCAT)
+WHITE, BLACK, HISPANIC, ASIAN, NATIVE, PACIFIC, MULTI = 1, 2, 4, 5, 6, 7, 9
+# BLOOD_TYPE codes; 0 is unknown
+BLOOD_TYPES = {"O": 1, "A": 2, "B": 3, "AB": 4, "A1": 5, "A2": 6, "A1B": 7, "A2B": 8}
+# DIABETIC codes (KIDPAN DIAB); 0 is unknown
+NO_DIABETES, TYPE1_DIABETES, TYPE2_DIABETES, OTHER_DIABETES = 1, 2, 3, 4
+
+# HLA-A, -B and -DR antigens packed 10 bits each into one uint64
+HLA_COLUMNS = ["A1", "A2", "B1", "B2", "DR1", "DR2"]
+HLA_BITS = 10
+
+def to_days(years):
+    return np.round(np.asarray(years) * DAYS_PER_YEAR).astype(np.int32)
+
+def to_years(days):
+    days = np.asarray(days)
+    return np.where(days == NEVER, np.nan, days / DAYS_PER_YEAR)
+
+def race_codes(agents):
+    if "ETHCAT" in agents: return np.asarray(agents["ETHCAT"]).astype(np.int8)
+    # NHIS rows only carry dummies; Hispanic ethnicity takes precedence as in ETHCAT
+    return np.select(
+        [np.asarray(agents["IS_HISPANIC"], dtype=bool), np.asarray(agents["IS_WHITE"], dtype=bool), np.asarray(agents["IS_BLACK"], dtype=bool)],
+        [HISPANIC, WHITE, BLACK],
+        0
+    ).astype(np.int8)
+
+def blood_type_codes(abo):
+    return np.array([BLOOD_TYPES.get(str(blood_type).strip(), 0) for blood_type in abo], dtype=np.int8)
+
+def diabetic_codes(agents):
+    if "DIAB" in agents:
+        diab = np.asarray(agents["DIAB"], dtype=float)
+        return np.where((diab >= 1) & (diab <= 4), diab, 0).astype(np.int8)
+    # NHIS DIABTYPE: 0 not diabetic, 1 type 1, 2 type 2, otherwise other
+    diabtype = np.asarray(agents["DIABTYPE"], dtype=float)
+    return np.select([diabtype == 0, diabtype == 1, diabtype == 2], [NO_DIABETES, TYPE1_DIABETES, TYPE2_DIABETES], OTHER_DIABETES).astype(np.int8)
+
+def pack_hla(agents):
+    """
+    :param agents: table with the KIDPAN A1, A2, B1, B2, DR1, DR2 antigen columns
+    :return: uint64 per agent with each antigen in 10 bits (0 if unknown); four-digit split codes such as
+        DR1403 are stored as their broad antigen (DR14)
+    """
+    packed = np.zeros(len(agents[HLA_COLUMNS[0]]), dtype=np.uint64)
+    for i, column in enumerate(HLA_COLUMNS):
+        antigen = np.nan_to_num(np.asarray(agents[column], dtype=float)).astype(np.int64)
+        antigen = np.where(antigen >= 2**HLA_BITS - 1, antigen // 100, antigen)
+        antigen = np.clip(antigen, 0, 2**HLA_BITS - 1).astype(np.uint64)
+        packed |= antigen << np.uint64(HLA_BITS * i)
+    return packed
+
+def unpack_hla(packed):
+    # (n, 6) array of A1, A2, B1, B2, DR1, DR2 antigens
+    packed = np.asarray(packed, dtype=np.uint64)
+    mask = np.uint64(2**HLA_BITS - 1)
+    return np.stack([(packed >> np.uint64(HLA_BITS * i)) & mask for i in range(len(HLA_COLUMNS))], axis=-1).astype(np.int16)
+
+def compact_codes(agents):
+    """
+    :param agents: kidpan_data/nhis_data table or cohort from AgentManager
+    :return: dict of the coded columns (RACE, DIABETIC, and BLOOD_TYPE/HLA when the table has ABO/HLA columns)
+    """
+    codes = {"RACE": race_codes(agents)}
+    if "DIAB" in agents or "DIABTYPE" in agents: codes["DIABETIC"] = diabetic_codes(agents)
+    if "ABO" in agents: codes["BLOOD_TYPE"] = blood_type_codes(agents["ABO"])
+    if all(column in agents for column in HLA_COLUMNS): codes["HLA"] = pack_hla(agents)
+    return codes
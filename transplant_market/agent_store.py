@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from agent_records import NEVER
+
+# columns tracked for agents in the market, in the narrowest dtype that holds them: dummies are bools, codes
+# int8 (see agent_records), physiological values float32 and event times int32 day offsets from the start of
+# the simulation that stay NEVER until the event happens. AGENT_ID is unique over both sides of the market and
+# never reused, unlike SOURCE_ROW (shared by agents drawn from the same row) and store rows (renumbered by
+# compact). AGE is the age in years on the current day; the simulator recomputes it every step from BIRTH_DAY,
+# a day offset like the event times, so that it does not drift with float32 rounding. REGION is a regions.RegionTable code, 0 for every agent of an unsharded market. Valuations and prices
+# stay float64 so that fees of a few dollars are not rounded away from valuations in the millions. An agent dies
+# once its CUMULATIVE_HAZARD, summed over the steps it lived, reaches the DEATH_HAZARD drawn on its arrival.
+BUYER_COLUMNS = {
+    "AGENT_ID": np.int64,
+    "SOURCE_ROW": np.int32,
+    "AGE": np.float32,
+    "BIRTH_DAY": np.int32,
+    "RACE": np.int8,
+    "BLOOD_TYPE": np.int8,
+    "DIABETIC": np.int8,
+    "IS_MALE": np.bool_,
+    "IS_WHITE": np.bool_,
+    "IS_BLACK": np.bool_,
+    "IS_HISPANIC": np.bool_,
+    "HAS_DIABETES": np.bool_,
+    "PRIOR_TRANSPLANT": np.bool_,
+    "WORK_INCOME_TCR": np.bool_,
+    "GFR": np.float32,
+    "EDUCATION": np.int8,
+    "HLA": np.uint64,
+    "ZIP": np.int32,
+    "REGION": np.int16,
+    "ENTRANCE_DAY": np.int32,
+    "TRANSPLANT_DAY": np.int32,
+    "DEATH_DAY": np.int32,
+    "VALUATION": np.float64,
+    "PRICE": np.float64,
+    "DEATH_HAZARD": np.float64,
+    "CUMULATIVE_HAZARD": np.float64,
+}
+SELLER_COLUMNS = {
+    "AGENT_ID": np.int64,
+    "SOURCE_ROW": np.int32,
+    "AGE": np.float32,
+    "BIRTH_DAY": np.int32,
+    "RACE": np.int8,
+    "BLOOD_TYPE": np.int8,
+    "DIABETIC": np.int8,
+    "IS_MALE": np.bool_,
+    "IS_WHITE": np.bool_,
+    "IS_BLACK": np.bool_,
+    "IS_HISPANIC": np.bool_,
+    "HAS_DIABETES": np.bool_,
+    "EDUC": np.int16,
+    "BMI": np.float32,
+    "HEIGHT": np.float32,
+    "MORTALITY_PREDICTOR": np.float32,
+    "HLA": np.uint64,
+    "ZIP": np.int32,
+    "REGION": np.int16,
+    "ENTRANCE_DAY": np.int32,
+    "TRANSPLANT_DAY": np.int32,
+    "DEATH_DAY": np.int32,
+    "VALUATION": np.float64,
+    "PRICE": np.float64,
+    "DEATH_HAZARD": np.float64,
+    "CUMULATIVE_HAZARD": np.float64,
+}
+# values of columns not given on append; other float columns are NaN and the rest 0 (unknown codes)
+FILL_VALUES = {"ENTRANCE_DAY": NEVER, "TRANSPLANT_DAY": NEVER, "DEATH_DAY": NEVER, "CUMULATIVE_HAZARD": 0}
+
+class AgentStore:
+    """
+    Append-only columnar store of agents. Columns are preallocated and double in capacity when full,
+    so appending a cohort costs amortized O(cohort size) instead of copying the whole population.
+    """
+    def __init__(self, columns, capacity=1024, fill_values=FILL_VALUES):
+        """
+        :param columns: dict of column name -> dtype
+        :param capacity: initial number of agents allocated
+        :param fill_values: dict of column name -> value of appended agents whose cohort lacks the column
+        """
+        self.dtypes = {column: np.dtype(dtype) for column, dtype in columns.items()}
+        self.fill_values = fill_values
+        self.columns = {column: np.empty(capacity, dtype) for column, dtype in self.dtypes.items()}
+        self.capacity = capacity
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, column):
+        # a view of the live rows; writes through it update the store
+        return self.columns[column][:self.size]
+
+    def __contains__(self, column):
+        return column in self.columns
+
+    def reserve(self, capacity):
+        if capacity <= self.capacity: return
+        capacity = max(capacity, 2*self.capacity)
+        for column, values in self.columns.items():
+            grown = np.empty(capacity, self.dtypes[column])
+            grown[:self.size] = values[:self.size]
+            self.columns[column] = grown
+        self.capacity = capacity
+
+    def append(self, cohort, **fields):
+        """
+        :param cohort: struct-of-arrays cohort (dict of column -> array), e.g. from AgentManager.generate_recipients
+        :param fields: scalar or per-agent values for further columns, e.g. ENTRANCE_DAY=day
+        :return: slice of the appended rows
+        """
+        n = len(next(iter(cohort.values()))) if cohort else 0
+        self.reserve(self.size + n)
+        rows = slice(self.size, self.size + n)
+        for column, values in self.columns.items():
+            if column in fields: values[rows] = fields[column]
+            elif column in cohort: values[rows] = cohort[column]
+            elif column in self.fill_values: values[rows] = self.fill_values[column]
+            elif self.dtypes[column].kind == "f": values[rows] = np.nan
+            else: values[rows] = 0
+        self.size += n
+        return rows
+
+    def compact(self, keep):
+        """
+        :param keep: boolean mask of the live rows to keep; the others are dropped and the kept rows renumbered in order
+        """
+        n = np.count_nonzero(keep)
+        for values in self.columns.values():
+            values[:n] = values[:self.size][keep]
+        self.size = n
+
+    def __getstate__(self):
+        # only the live rows are pickled, e.g. in Simulator checkpoints
+        return {**self.__dict__, "columns": {column: self[column].copy() for column in self.columns}, "capacity": self.size}
+
+    def select(self, rows, columns=None):
+        """
+        :param rows: boolean mask or indices into the live rows
+        :param columns: columns to copy out, all of them by default
+        :return: struct-of-arrays cohort (dict of column -> array) of the selected agents
+        """
+        if columns is None: columns = self.columns
+        return {column: self[column][rows] for column in columns}
+
+    @property
+    def nbytes(self):
+        # memory held by the live rows
+        return self.size * sum(dtype.itemsize for dtype in self.dtypes.values())
+
+    def to_records(self):
+        # the live rows as one NumPy structured array, e.g. for saving a compact snapshot
+        records = np.empty(self.size, dtype=list(self.dtypes.items()))
+        for column in self.columns: records[column] = self[column]
+        return records
+
+    def to_frame(self):
+        return pd.DataFrame({column: self[column] for column in self.columns})
@@ -0,0 +1,248 @@
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import clearing_price
+from agent_manager import AgentManager
+from agent_records import NEVER
+from agent_store import AgentStore, BUYER_COLUMNS, SELLER_COLUMNS
+from simulator import Simulator
+from regions import RegionTable
+
+# Reproducible timings of the market's hot paths. Run `python benchmarks.py --output results.json` and compare two
+# result files with `python benchmarks.py --compare old.json new.json`.
+
+SIZES = [10**2, 10**3, 10**4, 10**5, 10**6, 10**7]
+
+def synthetic_tables(n_recipients=10000, n_givers=20000, seed=0):
+    """
+    KIDPAN/NHIS-shaped tables with the columns load_kidpan_data and load_nhis_data leave behind, so that an
+    AgentManager can be built with AgentManager.from_tables without the licensed STAR/IPUMS files.
+    :return: (kidpan_data, nhis_data)
+    """
+    rng = np.random.default_rng(seed)
+    kidpan_data = pd.DataFrame({
+        "WL_ORG": "KI",
+        "NUM_PREV_TX": rng.choice([0., 1., 2.], n_recipients, p=[0.85, 0.12, 0.03]),
+        "GFR": rng.uniform(5, 20, n_recipients),
+        "GENDER": rng.choice(["M", "F"], n_recipients),
+        "EDUCATION": rng.integers(1, 7, n_recipients).astype(float),
+        "DIAB": rng.integers(1, 5, n_recipients).astype(float),
+        "INIT_AGE": rng.integers(18, 80, n_recipients).astype(float),
+        "ETHCAT": rng.choice([1, 2, 4], n_recipients, p=[0.5, 0.3, 0.2]),
+        "WORK_INCOME_TCR": rng.random(n_recipients) < 0.4,
+        "DON_TY": "C",
+    })
+    kidpan_data["IS_MALE"] = (kidpan_data["ETHCAT"] == 1)
+    kidpan_data["IS_WHITE"] = (kidpan_data["ETHCAT"] == 1)
+    kidpan_data["IS_BLACK"] = (kidpan_data["ETHCAT"] == 2)
+    kidpan_data["IS_HISPANIC"] = (kidpan_data["ETHCAT"] == 4)
+    kidpan_data["HAS_DIABETES"] = (kidpan_data["ETHCAT"] != 1)
+    kidpan_data["PRIOR_TRANSPLANT"] = (kidpan_data["NUM_PREV_TX"] > 0)
+
+    racenew = rng.choice([100, 200], n_givers, p=[0.8, 0.2])
+    hispeth = rng.choice([10, 20], n_givers, p=[0.8, 0.2])
+    nhis_data = pd.DataFrame({
+        "AGE": rng.integers(18, 85, n_givers),
+        "RACENEW": racenew,
+        "SEX": rng.integers(1, 3, n_givers),
+        "HEIGHT": rng.integers(58, 77, n_givers),
+        "WEIGHT": rng.integers(100, 280, n_givers),
+        "EDUC": rng.choice([103, 201, 302, 301, 400, 501], n_givers),
+        "DIABTYPE": 0,
+        "HISPETH": hispeth,
+    })
+    nhis_data["IS_MALE"] = (nhis_data["SEX"] == 1)
+    nhis_data["BMI"] = nhis_data["WEIGHT"] / (nhis_data["HEIGHT"])**2 * 703.07
+    nhis_data["HAS_DIABETES"] = (nhis_data["DIABTYPE"] != 0)
+    nhis_data["IS_WHITE"] = (nhis_data["RACENEW"] == 100)
+    nhis_data["IS_BLACK"] = (nhis_data["RACENEW"] == 200)
+    nhis_data["IS_HISPANIC"] = (nhis_data["HISPETH"] != 10) & (nhis_data["HISPETH"] < 90)
+    return kidpan_data, nhis_data
+
+# each benchmark does its setup for n agents and returns the zero-argument callable that is timed, or a tuple of it,
+# an untimed reset called before every call (for callables that change the state they run on) and a close called
+# after the last call (to release what the setup acquired); reset and close may be None
+
+def market_values(rng, n):
+    # unique valuations so that the binary and linear searches accept them
+    return rng.normal(50000, 10000, n), rng.normal(45000, 10000, n)
+
+def bench_clearing_price(search_type):
+    def setup(am, n, rng):
+        buyer_values, seller_values = market_values(rng, n)
+        return lambda : clearing_price.find_clearing_price(buyer_values, seller_values, search_type)
+    return setup
+
+def bench_median_clearing_price(am, n, rng):
+    buyer_values, seller_values = market_values(rng, n)
+    return lambda : clearing_price.find_median_clearing_price(buyer_values, seller_values)
+
+def bench_giver_income(am, n, rng):
+    givers = am.generate_givers(n, rng)
+    return lambda : am.giver_income(givers, givers["AGE"])
+
+def bench_giver_mortality(am, n, rng):
+    givers = am.generate_givers(n, rng)
+    return lambda : am.giver_mortality(givers, givers["AGE"])
+
+def bench_recipient_mortality_dialysis(am, n, rng):
+    recipients = am.generate_recipients(n, rng)
+    return lambda : am.receipient_mortality_dialysis(recipients, recipients["AGE"])
+
+def bench_recipient_mortality_transplant(am, n, rng):
+    recipients = am.generate_recipients(n, rng)
+    return lambda : am.recipient_mortality_transplant(recipients, 1, recipients["AGE"])
+
+def bench_value_recipients(am, n, rng):
+    recipients = am.generate_recipients(n, rng)
+    return lambda : am.value_recipients(recipients)
+
+def bench_value_givers(am, n, rng):
+    givers = am.generate_givers(n, rng)
+    return lambda : am.value_givers(givers)
+
+def bench_simulator_step(am, n, rng):
+    # a market already holding n searching buyers and n searching sellers, with arrivals of a tenth of that a year;
+    # every call steps from the same state, as a step adds arrivals and removes trades and deaths
+    simulation = Simulator(am, n/10, n/10, rng=rng)
+    simulation.buyers = AgentStore(BUYER_COLUMNS, capacity=2*n)
+    simulation.admit(simulation.buyers, am.generate_recipients(n, rng), "BUYER_DEATH", ENTRANCE_DAY=0)
+    simulation.sellers = AgentStore(SELLER_COLUMNS, capacity=2*n)
+    simulation.admit(simulation.sellers, am.generate_givers(n, rng), "SELLER_DEATH", ENTRANCE_DAY=0)
+    stores = [(store, len(store), {column: store[column].copy() for column in store.columns}) for store in [simulation.buyers, simulation.sellers]]
+    streams = {name: stream.bit_generator.state for name, stream in simulation.streams.items()}
+    agents = simulation.agents
+    def reset():
+        for store, size, columns in stores:
+            store.size = size
+            for column, values in columns.items(): store[column][:] = values
+        for name, stream in simulation.streams.items(): stream.bit_generator.state = streams[name]
+        simulation.time = simulation.steps = 0
+        simulation.agents = agents
+        simulation.history = []
+    return simulation.step, reset
+
+def bench_clearing(n_regions):
+    # one clearing of a market holding n searching buyers and n searching sellers, national or split evenly into regions
+    def setup(am, n, rng):
+        regions = None if n_regions is None else RegionTable(np.arange(n_regions), np.arange(n_regions))
+        simulation = Simulator(am, 0, 0, rng=rng, regions=regions)
+        buyer_values, seller_values = market_values(rng, n)
+        simulation.buyers = AgentStore(BUYER_COLUMNS, capacity=n)
+        simulation.buyers.append({"VALUATION": buyer_values}, ENTRANCE_DAY=0, REGION=rng.integers(0, n_regions or 1, n))
+        simulation.sellers = AgentStore(SELLER_COLUMNS, capacity=n)
+        simulation.sellers.append({"VALUATION": seller_values}, ENTRANCE_DAY=0, REGION=rng.integers(0, n_regions or 1, n))
+        if regions is not None: simulation.clearing_pool = ThreadPoolExecutor()
+        searching = np.ones(n, dtype=bool)
+        def reset():
+            simulation.buyers["TRANSPLANT_DAY"][:] = NEVER
+            simulation.sellers["TRANSPLANT_DAY"][:] = NEVER
+        def close():
+            if simulation.clearing_pool is not None: simulation.clearing_pool.shutdown()
+        return lambda : simulation.clear(searching, searching), reset, close
+    return setup
+
+# benchmark name -> (setup, largest market size it is run at by default)
+BENCHMARKS = {
+    "find_clearing_price_binary": (bench_clearing_price("binary"), 10**7),
+    "find_clearing_price_linear": (bench_clearing_price("linear"), 10**4), # quadratic in the market size
+    "find_clearing_price_sweep": (bench_clearing_price("sweep"), 10**7),
+    "find_median_clearing_price": (bench_median_clearing_price, 10**7),
+    "giver_income": (bench_giver_income, 10**7),
+    "giver_mortality": (bench_giver_mortality, 10**7),
+    "recipient_mortality_dialysis": (bench_recipient_mortality_dialysis, 10**7),
+    "recipient_mortality_transplant": (bench_recipient_mortality_transplant, 10**7),
+    "value_recipients": (bench_value_recipients, 10**6),
+    "value_givers": (bench_value_givers, 10**6),
+    "simulator_step": (bench_simulator_step, 10**6),
+    "clearing_national": (bench_clearing(None), 10**7),
+    "clearing_11_regions": (bench_clearing(11), 10**7),
+    "clearing_58_regions": (bench_clearing(58), 10**7),
+}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(names=None, sizes=SIZES, repeat=3, seed=0, max_size=None, verbose=True):
+    """
+    :param names: benchmarks to run, all of BENCHMARKS by default
+    :param sizes: market sizes to run each benchmark at
+    :param repeat: timed calls per benchmark and size, after one untimed warm-up call
+    :param seed: seed of the synthetic tables and of every benchmark's numpy.random.Generator
+    :param max_size: overrides each benchmark's default largest size
+    :return: dict with the environment and one result per benchmark and size (seconds: min, median, mean)
+    """
+    am = AgentManager.from_tables(*synthetic_tables(seed=seed))
+    results = []
+    for name in BENCHMARKS if names is None else names:
+        setup, default_max_size = BENCHMARKS[name]
+        for n in sizes:
+            if n > (default_max_size if max_size is None else max_size): continue
+            calls = setup(am, n, np.random.default_rng(seed))
+            calls = calls if isinstance(calls, tuple) else (calls,)
+            fxn, reset, close = calls + (None,) * (3 - len(calls))
+            timings = []
+            try:
+                for i in range(repeat + 1):
+                    if reset is not None: reset()
+                    start_time = time.perf_counter()
+                    fxn()
+                    # the first call is an untimed warm-up
+                    if i > 0: timings.append(time.perf_counter() - start_time)
+            finally:
+                if close is not None: close()
+            results.append({"benchmark": name, "size": n, "repeat": repeat, "min": min(timings), "median": float(np.median(timings)), "mean": float(np.mean(timings))})
+            if verbose: print(f"{name:32} {n:>10} {min(timings):12.6f}s")
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "results": results,
+    }
+
+def compare(old_results, new_results, threshold=1.2):
+    """
+    :param old_results, new_results: dicts from run_benchmarks (or the JSON files they were saved to)
+    :param threshold: ratio of new to old minimum time above which a benchmark counts as a regression
+    :return: DataFrame of the benchmarks and sizes in both, with their RATIO and whether they REGRESSED
+    """
+    old = pd.DataFrame(old_results["results"]).set_index(["benchmark", "size"])["min"]
+    new = pd.DataFrame(new_results["results"]).set_index(["benchmark", "size"])["min"]
+    comparison = pd.DataFrame({"OLD": old, "NEW": new}).dropna()
+    comparison["RATIO"] = comparison["NEW"] / comparison["OLD"]
+    comparison["REGRESSED"] = comparison["RATIO"] > threshold
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the clearing price, agent model and simulator hot paths.")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), help="benchmarks to run (default: all)")
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES, help="market sizes")
+    parser.add_argument("--max-size", type=int, help="override each benchmark's largest default size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two saved result files instead of running")
+    parser.add_argument("--threshold", type=float, default=1.2)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as old_file, open(args.compare[1]) as new_file:
+            comparison = compare(json.load(old_file), json.load(new_file), args.threshold)
+        print(comparison.to_string())
+        raise SystemExit(int(comparison["REGRESSED"].any()))
+
+    results = run_benchmarks(args.benchmarks, args.sizes, args.repeat, args.seed, args.max_size)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=1)
@@ -1,7 +1,12 @@
 import numpy as np
 import pandas as pd
+from typing import NamedTuple
 
-def find_clearing_price(buyer_product_values, seller_product_values, search_type="binary"):
+def find_clearing_price(buyer_product_values, seller_product_values, search_type="sweep"):
+    if search_type == "sweep":
+        return find_clearing_price_sweep(buyer_product_values, seller_product_values)
+
+    # the binary and linear searches only work if every buyer/seller has a unique product_value
     combined = np.concatenate([buyer_product_values, seller_product_values])
     assert(np.unique(combined).size == combined.size)
 
@@ -70,12 +75,237 @@ def find_clearing_price_binary(buyer_product_values, seller_product_values):
     max_bound = significant_values[significant_values >= clearing_price_estimate][0]
     return [min_bound, max_bound]
 
-def find_median_clearing_price(buyer_product_values, seller_product_values, search_type="binary"):
+# the k-th smallest (1-indexed) value of the union of two sorted arrays, in O(log n)
+def kth_smallest(sorted_a, sorted_b, k):
+    lo, hi = max(0, k - len(sorted_b)), min(k, len(sorted_a))
+    while lo < hi:
+        i = (lo + hi) // 2
+        if sorted_a[i] < sorted_b[k-i-1]: lo = i + 1
+        else: hi = i
+    candidates = []
+    if lo > 0: candidates.append(sorted_a[lo-1])
+    if k - lo > 0: candidates.append(sorted_b[k-lo-1])
+    return max(candidates)
+
+# quantity demanded minus quantity supplied at a price
+def excess_demand(sorted_buyer_values, sorted_seller_values, price):
+    q_demanded = len(sorted_buyer_values) - np.searchsorted(sorted_buyer_values, price, side="left")
+    q_supplied = np.searchsorted(sorted_seller_values, price, side="right")
+    return q_demanded - q_supplied
+
+class ClearingInterval(NamedTuple):
+    min_bound: float
+    max_bound: float
+    min_closed: bool # whether min_bound itself clears the market
+    max_closed: bool # whether max_bound itself clears the market
+    exact: bool # False if ties keep quantity demanded and supplied from ever being equal; the interval is then the
+                # single price at which excess demand changes sign, and the long side must be rationed
+
+# clearing interval of already sorted valuations in O(log n); repeated product_values are allowed
+# excess demand is non-increasing in price, and the interval where it changes sign always lies between the
+# n-th and (n+1)-th smallest of all valuations, n being the number of buyers
+def find_clearing_interval_sorted(sorted_buyer_values, sorted_seller_values):
+    # make sure there are not no buyers or sellers
+    if len(sorted_buyer_values) == 0 or len(sorted_seller_values) == 0: return None
+    # make sure a clearing price exists; i.e. there is at least one deal that can be made
+    if sorted_buyer_values[-1] < sorted_seller_values[0]: return None
+
+    n = len(sorted_buyer_values)
+    lower = kth_smallest(sorted_buyer_values, sorted_seller_values, n)
+    upper = kth_smallest(sorted_buyer_values, sorted_seller_values, n+1)
+    lower_clears = bool(excess_demand(sorted_buyer_values, sorted_seller_values, lower) == 0)
+    upper_clears = bool(excess_demand(sorted_buyer_values, sorted_seller_values, upper) == 0)
+    # excess demand is exactly zero on the open interval (lower, upper) whenever it is non-empty, so only a tie
+    # at a single price can keep the market from clearing exactly
+    if lower < upper: return ClearingInterval(lower, upper, lower_clears, upper_clears, True)
+    return ClearingInterval(lower, upper, True, True, lower_clears)
+
+def find_clearing_price_sorted(sorted_buyer_values, sorted_seller_values):
+    interval = find_clearing_interval_sorted(sorted_buyer_values, sorted_seller_values)
+    if interval is None or not interval.exact: return None
+    return [interval.min_bound, interval.max_bound]
+
+# sorts once and reads the clearing interval off the order statistics; works with repeated product_values
+def find_clearing_price_sweep(buyer_product_values, seller_product_values):
+    return find_clearing_price_sorted(np.sort(buyer_product_values), np.sort(seller_product_values))
+
+def find_clearing_interval(buyer_product_values, seller_product_values):
+    return find_clearing_interval_sorted(np.sort(buyer_product_values), np.sort(seller_product_values))
+
+# decides which of the agents willing to trade at the price actually trade, given the traded quantity
+# agents strictly inside the price always trade; the remaining quantity is split among the agents tied at the price
+def ration(willing, strictly_willing, quantity, rationing="random", rng=None):
+    tied = np.flatnonzero(willing & ~strictly_willing)
+    remaining = quantity - np.count_nonzero(strictly_willing)
+    if rationing == "random":
+        allocation = strictly_willing.copy()
+        if rng is None: rng = np.random.default_rng()
+        allocation[rng.choice(tied, size=min(remaining, tied.size), replace=False)] = True
+    elif rationing == "pro-rata":
+        allocation = strictly_willing.astype(float)
+        if tied.size > 0: allocation[tied] = min(remaining / tied.size, 1)
+    else:
+        raise Exception("Invalid rationing")
+    return allocation
+
+def clear_market(buyer_product_values, seller_product_values, rationing="random", rng=None):
+    """
+    Clears the market at the median clearing price even when ties keep it from clearing exactly, in O(n log n).
+    :param rationing: "random" picks which tied agents on the long side trade uniformly at random;
+        "pro-rata" gives every tied agent on the long side the same fraction of a trade
+    :param rng: numpy.random.Generator used by random rationing
+    :return: (price, interval, buyer_allocation, seller_allocation) with allocations aligned with the inputs
+        (bool for random rationing, fraction traded for pro-rata), or None if no deal can be made
+    """
+    buyer_product_values = np.asarray(buyer_product_values, dtype=float)
+    seller_product_values = np.asarray(seller_product_values, dtype=float)
+    interval = find_clearing_interval(buyer_product_values, seller_product_values)
+    if interval is None: return None
+
+    price = (interval.min_bound + interval.max_bound) / 2
+    willing_buyers = buyer_product_values >= price
+    willing_sellers = seller_product_values <= price
+    quantity = min(np.count_nonzero(willing_buyers), np.count_nonzero(willing_sellers))
+    buyer_allocation = ration(willing_buyers, buyer_product_values > price, quantity, rationing, rng)
+    seller_allocation = ration(willing_sellers, seller_product_values < price, quantity, rationing, rng)
+    return price, interval, buyer_allocation, seller_allocation
+
+class SortedValues:
+    """
+    Sorted array of valuations in a preallocated buffer with free space on both ends, so removing the
+    strongest buyers/weakest sellers after a clearing is O(1) and inserts shift only the shorter side.
+    """
+    def __init__(self, capacity=1024):
+        self.buffer = np.empty(capacity)
+        self.start = self.stop = capacity // 2
+
+    def __len__(self):
+        return self.stop - self.start
+
+    @property
+    def values(self):
+        return self.buffer[self.start:self.stop]
+
+    def _recenter(self, capacity):
+        values = self.values.copy()
+        self.buffer = np.empty(capacity)
+        self.start = (capacity - values.size) // 2
+        self.stop = self.start + values.size
+        self.buffer[self.start:self.stop] = values
+
+    def insert(self, value):
+        i = self.start + np.searchsorted(self.values, value)
+        if i - self.start < self.stop - i and self.start > 0:
+            self.buffer[self.start-1:i-1] = self.buffer[self.start:i]
+            self.start -= 1
+            self.buffer[i-1] = value
+        elif self.stop < self.buffer.size:
+            self.buffer[i+1:self.stop+1] = self.buffer[i:self.stop]
+            self.stop += 1
+            self.buffer[i] = value
+        else:
+            self._recenter(self.buffer.size if 4*len(self) < self.buffer.size else 2*self.buffer.size)
+            self.insert(value)
+
+    def insert_many(self, values):
+        # merges the values in place: only the values between the insertion points and the nearer end of the buffer
+        # move, into the slack on that end, so nothing is re-sorted and the buffer only grows once the slack runs out
+        values = np.sort(np.asarray(values, dtype=float))
+        k = values.size
+        if k == 0: return
+        positions = np.searchsorted(self.values, values, side="right")
+        if positions[-1] < len(self) - positions[0] and self.start >= k:
+            head = self.buffer[self.start:self.start+positions[-1]]
+            self.buffer[self.start-k:self.start+positions[-1]] = np.insert(head, positions, values)
+            self.start -= k
+        elif self.stop + k <= self.buffer.size:
+            tail = self.buffer[self.start+positions[0]:self.stop]
+            self.buffer[self.start+positions[0]:self.stop+k] = np.insert(tail, positions - positions[0], values)
+            self.stop += k
+        else:
+            self._recenter(max(self.buffer.size, 2*(len(self) + k)))
+            self.insert_many(values)
+
+    def remove_at(self, index):
+        i = self.start + index
+        if index < len(self) // 2:
+            self.buffer[self.start+1:i+1] = self.buffer[self.start:i]
+            self.start += 1
+        else:
+            self.buffer[i:self.stop-1] = self.buffer[i+1:self.stop]
+            self.stop -= 1
+
+    def remove(self, value):
+        index = np.searchsorted(self.values, value)
+        if index == len(self) or self.values[index] != value: raise ValueError("value not in SortedValues")
+        self.remove_at(index)
+
+    def remove_indices(self, indices):
+        kept = np.delete(self.values, indices)
+        self.stop = self.start + kept.size
+        self.buffer[self.start:self.stop] = kept
+
+    def pop_first(self, count):
+        # removes and returns the count smallest values in O(1)
+        removed = self.buffer[self.start:self.start+count].copy()
+        self.start += count
+        return removed
+
+    def pop_last(self, count):
+        # removes and returns the count largest values in O(1)
+        removed = self.buffer[self.stop-count:self.stop].copy()
+        self.stop -= count
+        return removed
+
+class OrderBook:
+    """
+    Buyer and seller valuations kept sorted across calls, so an event-driven market can re-clear after each
+    arrival or death in O(log n) instead of sorting the whole market every event.
+    """
+    def __init__(self, buyer_product_values=(), seller_product_values=(), capacity=1024):
+        self.buyers = SortedValues(capacity)
+        self.sellers = SortedValues(capacity)
+        self.buyers.insert_many(np.asarray(buyer_product_values, dtype=float))
+        self.sellers.insert_many(np.asarray(seller_product_values, dtype=float))
+
+    def insert_buyer(self, value): self.buyers.insert(value)
+    def insert_seller(self, value): self.sellers.insert(value)
+    def remove_buyer(self, value): self.buyers.remove(value)
+    def remove_seller(self, value): self.sellers.remove(value)
+
+    def find_clearing_price(self):
+        return find_clearing_price_sorted(self.buyers.values, self.sellers.values)
+
+    def find_clearing_interval(self):
+        return find_clearing_interval_sorted(self.buyers.values, self.sellers.values)
+
+    def find_median_clearing_price(self):
+        price = self.find_clearing_price()
+        if price: return np.mean(price)
+        else: return None
+
+    def clear(self, price=None):
+        """
+        Makes all possible deals at price, removing the successful agents. By default the price is the middle of
+        the clearing interval, which is also used when ties keep the market from clearing exactly; the long side
+        is then rationed (tied valuations are interchangeable in the book, so which of them trade does not matter).
+        :return: the price and the product_values of the buyers and sellers that traded, or None if no deal
+        """
+        if price is None:
+            interval = self.find_clearing_interval()
+            if interval is None: return None
+            price = (interval.min_bound + interval.max_bound) / 2
+        q_demanded = len(self.buyers) - np.searchsorted(self.buyers.values, price, side="left")
+        q_supplied = np.searchsorted(self.sellers.values, price, side="right")
+        quantity = min(q_demanded, q_supplied)
+        return price, self.buyers.pop_last(quantity), self.sellers.pop_first(quantity)
+
+def find_median_clearing_price(buyer_product_values, seller_product_values, search_type="sweep"):
     price = find_clearing_price(buyer_product_values, seller_product_values, search_type)
     if price: return np.mean(price)
     else: return None
 
-def run_example(rand_seed=int(np.random.random()*1000), search_type="binary"):
+def run_example(rand_seed=int(np.random.random()*1000), search_type="sweep"):
     np.random.seed(rand_seed)
 
     # the max prices buyers are willing to pay, sorted from strong to weak
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Cleaned population tables are cached as one .npy file per column plus a meta.json holding the cache key.
+# The key covers the size and mtime of every source file and the version of the cleaning rules, so a new
+# data extract or a change to the cleaning code invalidates the cache automatically. Missing values of string
+# columns are saved as a separate {i}.null.npy mask, as .npy string arrays cannot hold NaN.
+
+FORMAT_VERSION = 2 # layout of the cache entries; entries of other versions are treated as missing
+
+def source_key(paths, version):
+    key = {"version": version, "sources": []}
+    for path in paths:
+        stat = os.stat(path)
+        key["sources"].append([os.path.abspath(path), stat.st_size, stat.st_mtime_ns])
+    return key
+
+def table_fingerprint(table):
+    # digest of a table's values row by row, e.g. to tell apart tables from different sources or synthetic draws
+    return hashlib.sha1(pd.util.hash_pandas_object(table, index=False).to_numpy().tobytes()).hexdigest()
+
+def _column_array(series):
+    # the array saved for a column and, for string columns with missing values, the mask of those values
+    if pd.api.types.is_bool_dtype(series): return series.to_numpy(dtype=bool), None
+    if pd.api.types.is_integer_dtype(series): return series.to_numpy(dtype=np.int64), None
+    if pd.api.types.is_numeric_dtype(series): return series.to_numpy(dtype=np.float64), None
+    null = series.isna().to_numpy()
+    return series.fillna("").astype(str).to_numpy(dtype=str), (null if null.any() else None)
+
+def _load_column(path, null_path):
+    values = np.load(path, mmap_mode="r")
+    if not os.path.exists(null_path): return values
+    values = values.astype(object)
+    values[np.load(null_path)] = np.nan
+    return values
+
+def _save_column(path, null_path, series):
+    values, null = _column_array(series)
+    np.save(path, values)
+    if null is not None: np.save(null_path, null)
+
+def load_table(cache_dir, name, key):
+    """
+    :return: the cached DataFrame, or None if there is no cache entry matching key
+    """
+    table_dir = os.path.join(cache_dir, name)
+    try:
+        with open(os.path.join(table_dir, "meta.json")) as meta_file:
+            meta = json.load(meta_file)
+    except (OSError, ValueError):
+        return None
+    if meta.get("format") != FORMAT_VERSION or meta["key"] != key: return None
+    columns = {column: _load_column(os.path.join(table_dir, f"{i}.npy"), os.path.join(table_dir, f"{i}.null.npy")) for i, column in enumerate(meta["columns"])}
+    index = _load_column(os.path.join(table_dir, "index.npy"), os.path.join(table_dir, "index.null.npy"))
+    return pd.DataFrame(columns, index=index)
+
+def save_table(cache_dir, name, key, table):
+    # write into a scratch directory of this writer's own and swap it in, so an interrupted write never leaves a
+    # valid-looking entry and processes filling the same cache at once never write into each other's files
+    table_dir = os.path.join(cache_dir, name)
+    os.makedirs(cache_dir, exist_ok=True)
+    scratch_dir = tempfile.mkdtemp(prefix=name + ".", suffix=".tmp", dir=cache_dir)
+    try:
+        for i, column in enumerate(table.columns):
+            _save_column(os.path.join(scratch_dir, f"{i}.npy"), os.path.join(scratch_dir, f"{i}.null.npy"), table[column])
+        _save_column(os.path.join(scratch_dir, "index.npy"), os.path.join(scratch_dir, "index.null.npy"), table.index.to_series())
+        with open(os.path.join(scratch_dir, "meta.json"), "w") as meta_file:
+            json.dump({"format": FORMAT_VERSION, "key": key, "columns": list(table.columns)}, meta_file)
+        shutil.rmtree(table_dir, ignore_errors=True)
+        try:
+            os.replace(scratch_dir, table_dir)
+        except OSError:
+            # another writer swapped its entry in after the old one was removed; it is kept instead of this one
+            pass
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
@@ -0,0 +1,124 @@
+import numpy as np
+import agent_records
+
+# ABO and HLA compatibility of sellers (donors) with buyers (recipients). Sellers with the same blood group and
+# HLA-A/B/DR antigens form one phenotype group; every antigen and every recipient blood group is a bitset over the
+# groups, so a query ORs a handful of bitsets instead of scanning every seller.
+#
+# Only KIDPAN recipients carry ABO and HLA typing. Sellers drawn from NHIS are untyped (BLOOD_TYPE 0, no HLA
+# antigens), and an untyped seller is compatible with every buyer, so with NHIS sellers the index restricts nothing.
+
+HLA_LOCI = ["A", "A", "B", "B", "DR", "DR"] # locus of each column of agent_records.unpack_hla
+LOCUS_OFFSETS = {"A": 0, "B": 1024, "DR": 2048} # antigen key = offset of the locus + antigen number
+
+# ABO antigens (bit 1: A, bit 2: B) of each agent_records BLOOD_TYPE code; -1 is unknown
+ABO_ANTIGENS = np.array([-1, 0, 1, 2, 3, 1, 1, 3, 3], dtype=np.int8)
+
+def abo_antigens_compatible(donor, recipient):
+    # a donor is compatible if the recipient carries every ABO antigen the donor does; unknown groups are compatible
+    return (donor < 0) | (recipient < 0) | ((donor & ~recipient) == 0)
+
+def abo_compatible(donor_blood_type, recipient_blood_type):
+    return abo_antigens_compatible(ABO_ANTIGENS[np.asarray(donor_blood_type)], ABO_ANTIGENS[np.asarray(recipient_blood_type)])
+
+def antigen_sets(unacceptable):
+    # the buyers sharing each non-empty set of unacceptable antigens, so that each set is evaluated once
+    sets = {}
+    for i, antigens in enumerate(unacceptable):
+        if len(antigens) > 0: sets.setdefault(tuple(sorted(set(np.asarray(antigens).tolist()))), []).append(i)
+    return sets
+
+def antigen_keys(antigens):
+    """
+    :param antigens: iterable of (locus, antigen) pairs, e.g. [("A", 2), ("B", 44), ("DR", 4)]
+    :return: int array of antigen keys
+    """
+    return np.array([LOCUS_OFFSETS[locus] + int(antigen) for locus, antigen in antigens], dtype=np.int64)
+
+class CompatibilityIndex:
+    """
+    Index of a seller pool answering which sellers are compatible with a buyer and what fraction of the pool a
+    buyer's unacceptable antigens rule out (cPRA). A seller is compatible with a buyer if their blood groups are
+    compatible and the seller carries none of the buyer's unacceptable HLA antigens. Simulator(compatibility_prefilter=True)
+    uses it to keep buyers without any ABO-compatible seller out of a clearing.
+    """
+    def __init__(self, blood_types, hla):
+        """
+        :param blood_types: agent_records BLOOD_TYPE code of each seller
+        :param hla: agent_records packed HLA typing of each seller
+        """
+        antigens = agent_records.unpack_hla(hla).astype(np.int64)
+        antigens[antigens > 0] += np.array([LOCUS_OFFSETS[locus] for locus in HLA_LOCI])[np.nonzero(antigens > 0)[1]]
+        # the two antigens of a locus are unordered
+        antigens = np.sort(antigens.reshape(-1, 3, 2), axis=2).reshape(-1, 6)
+        abo = ABO_ANTIGENS[np.asarray(blood_types)].astype(np.int64)
+        phenotypes, group, self.group_sizes = np.unique(np.column_stack([abo, antigens]), axis=0, return_inverse=True, return_counts=True)
+        group = group.ravel()
+        self.size = group.size
+        self.n_groups = self.group_sizes.size
+
+        # sellers listed group by group: the sellers of group g are members[starts[g]:starts[g]+group_sizes[g]]
+        self.members = np.argsort(group, kind="stable")
+        self.starts = np.concatenate([[0], np.cumsum(self.group_sizes)[:-1]])
+
+        # bitset over groups of the groups carrying each antigen
+        self.antigens = np.unique(phenotypes[:, 1:][phenotypes[:, 1:] > 0])
+        carriers = np.zeros((self.antigens.size, self.n_groups), dtype=bool)
+        rows = np.searchsorted(self.antigens, phenotypes[:, 1:])
+        present = phenotypes[:, 1:] > 0
+        carriers[rows[present], np.nonzero(present)[0]] = True
+        self.antigen_groups = np.packbits(carriers, axis=1)
+        # bitset over groups of the groups each recipient ABO code may receive from
+        self.abo_groups = np.packbits(abo_antigens_compatible(phenotypes[:, 0], ABO_ANTIGENS[:, None]), axis=1)
+        self.abo_counts = np.unpackbits(self.abo_groups, axis=1, count=self.n_groups) @ self.group_sizes
+
+    def __len__(self):
+        return self.size
+
+    def incompatible_groups(self, unacceptable):
+        # packed bitset of the groups carrying any of the unacceptable antigen keys; antigens no seller carries are ignored
+        unacceptable = np.asarray(unacceptable, dtype=np.int64)
+        rows = np.searchsorted(self.antigens, unacceptable[np.isin(unacceptable, self.antigens)])
+        return np.bitwise_or.reduce(self.antigen_groups[rows], axis=0) if rows.size else np.zeros(self.antigen_groups.shape[1], dtype=np.uint8)
+
+    def compatible_groups(self, blood_type, unacceptable=()):
+        """
+        :param blood_type: agent_records BLOOD_TYPE code of the buyer
+        :param unacceptable: antigen keys (see antigen_keys) the buyer has antibodies against
+        :return: boolean array over the phenotype groups
+        """
+        return np.unpackbits(self.abo_groups[blood_type] & ~self.incompatible_groups(unacceptable), count=self.n_groups).astype(bool)
+
+    def compatible_sellers(self, blood_type, unacceptable=()):
+        # indices of the compatible sellers, at a cost proportional to the groups and sellers returned
+        groups = np.flatnonzero(self.compatible_groups(blood_type, unacceptable))
+        sizes = self.group_sizes[groups]
+        offsets = np.repeat(self.starts[groups] - np.concatenate([[0], np.cumsum(sizes)[:-1]]), sizes)
+        return self.members[offsets + np.arange(sizes.sum())]
+
+    def compatible_counts(self, blood_types, unacceptable=None):
+        """
+        :param blood_types: BLOOD_TYPE code of each buyer
+        :param unacceptable: list with the unacceptable antigen keys of each buyer; None if no buyer is sensitized
+        :return: number of compatible sellers of each buyer, e.g. to keep buyers without any out of a clearing step
+        """
+        blood_types = np.asarray(blood_types)
+        counts = self.abo_counts[blood_types]
+        if unacceptable is None: return counts
+        for antigens, buyers in antigen_sets(unacceptable).items():
+            # compatible sellers of each recipient ABO code with these antigens unacceptable
+            compatible = np.unpackbits(self.abo_groups & ~self.incompatible_groups(antigens), axis=1, count=self.n_groups)
+            counts[buyers] = (compatible @ self.group_sizes)[blood_types[buyers]]
+        return counts
+
+    def cpra(self, unacceptable):
+        """
+        :param unacceptable: list with the unacceptable antigen keys of each buyer
+        :return: fraction of the seller pool carrying at least one of each buyer's unacceptable antigens (ABO is
+            not considered, as for the calculated panel reactive antibody)
+        """
+        cpra = np.zeros(len(unacceptable))
+        for antigens, buyers in antigen_sets(unacceptable).items():
+            incompatible = np.unpackbits(self.incompatible_groups(antigens), count=self.n_groups)
+            cpra[buyers] = (self.group_sizes @ incompatible) / self.size
+        return cpra
@@ -0,0 +1,112 @@
+import contextlib
+import cProfile
+import csv
+import json
+from time import perf_counter
+import tracemalloc
+import pandas as pd
+
+# Per-phase accounting of simulation steps. The Simulator wraps each phase of a step in instrumentation.phase(name)
+# and reports counters with instrumentation.count(name, k); at the end of a step one record of
+# {STEP, TIME, <PHASE>_SECONDS, <PHASE>_CALLS, <COUNTER>, ..., PEAK_MEMORY} is handed to every sink.
+
+class Instrumentation:
+    def __init__(self, sinks=(), track_memory=False, profile=False):
+        """
+        :param sinks: objects with a write(record) method, e.g. MemorySink, CSVSink, JSONLSink
+        :param track_memory: record each step's peak traced allocation (tracemalloc slows the simulation down)
+        :param profile: run a cProfile.Profile during steps; each phase is its own Simulator method, so the
+            stats (dump_profile) and sampling profilers such as py-spy break the time down by phase
+        """
+        self.sinks = list(sinks)
+        self.track_memory = track_memory
+        self.profiler = cProfile.Profile() if profile else None
+        self.record = None
+
+    def start_step(self, step, time):
+        self.record = {"STEP": step, "TIME": time}
+        self.step_start_time = perf_counter()
+        if self.track_memory:
+            if not tracemalloc.is_tracing(): tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.profiler is not None: self.profiler.enable()
+
+    def end_step(self, **counts):
+        """
+        :param counts: further per-step values to record, e.g. SEARCHING_BUYERS=...
+        :return: the record written to the sinks
+        """
+        if self.profiler is not None: self.profiler.disable()
+        self.record["STEP_SECONDS"] = perf_counter() - self.step_start_time
+        if self.track_memory: self.record["PEAK_MEMORY"] = tracemalloc.get_traced_memory()[1]
+        self.record.update(counts)
+        for sink in self.sinks: sink.write(self.record)
+        record, self.record = self.record, None
+        return record
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = perf_counter()
+        try:
+            yield
+        finally:
+            self.count(name + "_SECONDS", perf_counter() - start_time)
+            self.count(name + "_CALLS")
+
+    def count(self, name, k=1):
+        self.record[name] = self.record.get(name, 0) + k
+
+    def dump_profile(self, path):
+        # pstats-readable file, e.g. for snakeviz
+        self.profiler.dump_stats(path)
+
+    def close(self):
+        for sink in self.sinks:
+            if hasattr(sink, "close"): sink.close()
+
+class NullInstrumentation:
+    # instrumentation that is turned off: every hook returns immediately
+    def start_step(self, step, time): pass
+    def end_step(self, **counts): return None
+    def phase(self, name): return _NULL_PHASE
+    def count(self, name, k=1): pass
+    def close(self): pass
+
+_NULL_PHASE = contextlib.nullcontext()
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def to_frame(self):
+        return pd.DataFrame(self.records)
+
+class JSONLSink:
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, record):
+        # NumPy scalars are converted to the Python numbers they hold
+        self.file.write(json.dumps(record, default=lambda value : value.item()) + "\n")
+
+    def close(self):
+        self.file.close()
+
+class CSVSink:
+    # columns are fixed by the first record; phases or counters first seen later are dropped
+    def __init__(self, path):
+        self.file = open(path, "a", newline="")
+        self.writer = None
+
+    def write(self, record):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(record), extrasaction="ignore")
+            if self.file.tell() == 0: self.writer.writeheader()
+        self.writer.writerow(record)
+
+    def close(self):
+        self.file.close()
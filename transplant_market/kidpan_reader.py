@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Chunked reader of the STAR KIDPAN_DATA.DAT extract. Columns are looked up by name in the codebook that ships
+# with the repo, only the requested columns are parsed, and each chunk is filtered before the next one is read,
+# so memory is bounded by the chunk size and the surviving rows rather than by the whole extract.
+
+KIDPAN_COLNAMES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "KIDPAN_DATA_colnames.csv")
+
+def read_colnames(colnames_path=KIDPAN_COLNAMES_PATH):
+    """
+    :return: DataFrame indexed by LABEL with the POSITION (0-indexed field of the tab-delimited file) and TYPE
+        (Character or Numeric) of every KIDPAN column
+    """
+    colnames = pd.read_csv(colnames_path, encoding="utf-8-sig")
+    colnames["POSITION"] = colnames["Obs"] - 1
+    return colnames.set_index("LABEL")[["POSITION", "TYPE", "START", "END"]]
+
+def iter_kidpan_chunks(kidpan_path, columns, clean_chunk=None, chunksize=100000, has_header=False, colnames_path=KIDPAN_COLNAMES_PATH):
+    """
+    :param kidpan_path: STAR tab-delimited KIDPAN_DATA.DAT file
+    :param columns: names of the columns to read, as in KIDPAN_DATA_colnames.csv
+    :param clean_chunk: function DataFrame -> DataFrame applied to every chunk, e.g. to filter rows
+    :param chunksize: rows parsed at once
+    :param has_header: whether the first line of the file holds column names rather than a record
+    :return: generator of the (cleaned) chunks, Numeric columns as float with "." read as NaN and Character columns as str
+    """
+    colnames = read_colnames(colnames_path)
+    missing = [column for column in columns if column not in colnames.index]
+    if missing: raise KeyError(f"columns not in {colnames_path}: {missing}")
+    positions = colnames.loc[columns, "POSITION"].to_numpy()
+    # usecols yields fields in file order, so the names are assigned in that order
+    order = np.argsort(positions)
+    names = [columns[i] for i in order]
+    dtypes = {position: (float if colnames.loc[column, "TYPE"] == "Numeric" else str) for position, column in zip(positions[order], names)}
+    reader = pd.read_csv(
+        kidpan_path,
+        sep="\t",
+        header=None,
+        skiprows=1 if has_header else 0,
+        usecols=list(positions),
+        dtype=dtypes,
+        na_values=["."],
+        chunksize=chunksize
+    )
+    for chunk in reader:
+        chunk.columns = names
+        chunk = chunk[list(columns)]
+        yield chunk if clean_chunk is None else clean_chunk(chunk)
+
+def read_kidpan(kidpan_path, columns, clean_chunk=None, chunksize=100000, has_header=False, colnames_path=KIDPAN_COLNAMES_PATH):
+    # the surviving rows of every chunk, concatenated
+    chunks = list(iter_kidpan_chunks(kidpan_path, columns, clean_chunk, chunksize, has_header, colnames_path))
+    return pd.concat(chunks) if chunks else pd.DataFrame(columns=list(columns))
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+
+# Geography of a regionally sharded market. A table maps zip codes to allocation regions (OPTN regions, DSAs or
+# any other partition); agents are assigned the region of their zip code, and arriving agents without one draw a
+# zip code from the table. Regions are coded 0..n_regions-1 in sorted order of their labels.
+
+class RegionTable:
+    def __init__(self, zips, regions, weights=None):
+        """
+        :param zips: zip code of each row, as int (leading zeros dropped)
+        :param regions: region label of each zip code, e.g. OPTN region number or DSA code
+        :param weights: relative number of arriving agents living in each zip code, e.g. population; uniform by default
+        """
+        zips = np.asarray(zips, dtype=np.int32)
+        order = np.argsort(zips, kind="stable")
+        self.zips = zips[order]
+        if np.any(self.zips[1:] == self.zips[:-1]): raise ValueError("zip codes in the region table must be unique")
+        self.labels, codes = np.unique(np.asarray(regions)[order], return_inverse=True)
+        self.regions = codes.ravel().astype(np.int16)
+        weights = np.ones(self.zips.size) if weights is None else np.asarray(weights, dtype=float)[order]
+        self.probabilities = weights / weights.sum()
+
+    @classmethod
+    def from_csv(cls, path, zip_column="ZIP", region_column="REGION", weight_column=None):
+        """
+        :param path: csv file with one row per zip code
+        :param weight_column: column with the relative number of arriving agents of each zip code, if any
+        """
+        table = pd.read_csv(path, dtype={zip_column: int})
+        return cls(table[zip_column], table[region_column], None if weight_column is None else table[weight_column])
+
+    @property
+    def n_regions(self):
+        return self.labels.size
+
+    def region_of(self, zips):
+        # region code of each zip code; zip codes not in the table raise a KeyError
+        zips = np.asarray(zips)
+        index = np.minimum(np.searchsorted(self.zips, zips), self.zips.size - 1)
+        unknown = self.zips[index] != zips
+        if np.any(unknown): raise KeyError(f"zip codes not in the region table: {np.unique(zips[unknown])[:10].tolist()}")
+        return self.regions[index]
+
+    def draw(self, rng, n):
+        # zip codes and region codes of n arriving agents
+        rows = rng.choice(self.zips.size, size=n, p=self.probabilities)
+        return self.zips[rows], self.regions[rows]
+
+def shard_rows(regions, rows, n_regions):
+    """
+    :param regions: region code of every agent of a store
+    :param rows: indices of the agents to shard, ascending
+    :return: (rows sorted by region with one stable argsort, so still ascending within each region; bounds of each
+        region, whose agents are the contiguous slice rows[bounds[r]:bounds[r+1]])
+    """
+    regions = regions[rows]
+    bounds = np.zeros(n_regions + 1, dtype=np.intp)
+    np.cumsum(np.bincount(regions, minlength=n_regions), out=bounds[1:])
+    return rows[np.argsort(regions, kind="stable")], bounds
@@ -0,0 +1,133 @@
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import scipy as sp
+from simulator import Simulator
+from valuation_cache import ValuationCache
+
+# the AgentManager each worker process simulates with; inherited through fork, or set once per worker otherwise
+_shared_am = None
+# valuations reused by all replicates a process runs
+_valuation_cache = None
+
+def summarize_history(history):
+    # per-replicate outcomes of a Simulator run
+    return {
+        "TRANSPLANTS": history["TRANSPLANTS"].sum(),
+        "DEATHS": history["DEATHS"].sum(),
+        "MEAN_PRICE": history["PRICE"].mean(),
+        "FINAL_SEARCHING_BUYERS": history["SEARCHING_BUYERS"].iloc[-1],
+        "FINAL_SEARCHING_SELLERS": history["SEARCHING_SELLERS"].iloc[-1],
+    }
+
+def simulate_market(
+        am,
+        rng,
+        time_horizon=1,
+        buyer_fee_mean=0,
+        buyer_fee_sd=0,
+        seller_fee_mean=0,
+        seller_fee_sd=0,
+        seller_transplant_mortality_multiplier=1,
+        seller_transplant_income_multiplier=1,
+        valuation_cache_size=0,
+        **simulator_kwargs
+    ):
+    """
+    Runs one Simulator trajectory. Fees and seller multipliers are plain numbers so that parameter grids can be
+    sent to worker processes; the callables the Simulator expects are built here.
+    :param valuation_cache_size: if positive, valuations are cached across the replicates run by this process
+    :return: dict of outcome metrics
+    """
+    global _valuation_cache
+    if valuation_cache_size > 0 and (_valuation_cache is None or _valuation_cache.max_entries != valuation_cache_size):
+        _valuation_cache = ValuationCache(valuation_cache_size)
+    simulation = Simulator(
+        am,
+        buyer_fee=lambda rng, n : rng.normal(buyer_fee_mean, buyer_fee_sd, n),
+        seller_fee=lambda rng, n : rng.normal(seller_fee_mean, seller_fee_sd, n),
+        seller_transplant_mortality_fxn=lambda mort : mort * seller_transplant_mortality_multiplier,
+        seller_transplant_income_fxn=lambda inc : inc * seller_transplant_income_multiplier,
+        rng=rng,
+        valuation_cache=_valuation_cache if valuation_cache_size > 0 else None,
+        valuation_scenario=(seller_transplant_mortality_multiplier, seller_transplant_income_multiplier, simulator_kwargs.get("time_discounting")),
+        **simulator_kwargs
+    )
+    return summarize_history(simulation.run(time_horizon))
+
+def parameter_combinations(parameter_grid):
+    names = list(parameter_grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[parameter_grid[name] for name in names])]
+
+def _init_worker(am):
+    global _shared_am
+    _shared_am = am
+
+def _run_replicate(task):
+    simulate, parameters, replicate, seed_sequence = task
+    # spawning streams from a SeedSequence advances it, so every replicate starts from an unspawned copy; otherwise
+    # combinations sharing a seed in one process would get different streams and common random numbers break
+    seed_sequence = np.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key, pool_size=seed_sequence.pool_size)
+    metrics = simulate(_shared_am, np.random.default_rng(seed_sequence), **parameters)
+    return {**parameters, "REPLICATE": replicate, **metrics}
+
+def replicate_seeds(seed, n_combinations, n_replicates, common_random_numbers=False):
+    # SeedSequence of every replicate of every combination; with common random numbers replicate r of every
+    # combination gets the same seed, so differences between combinations are not swamped by sampling noise
+    root = np.random.SeedSequence(seed)
+    if common_random_numbers: return [root.spawn(n_replicates)] * n_combinations
+    return [combination_seed.spawn(n_replicates) for combination_seed in root.spawn(n_combinations)]
+
+def worker_pool(am, processes=None):
+    """
+    :return: multiprocessing pool whose workers simulate with am, or None if processes == 1 (run in this process)
+    """
+    _init_worker(am)
+    if processes == 1: return None
+    if "fork" in multiprocessing.get_all_start_methods():
+        # forked workers share the parent's AgentManager tables copy-on-write
+        return multiprocessing.get_context("fork").Pool(processes)
+    # without fork the tables are sent once per worker rather than reloaded from disk
+    return multiprocessing.get_context("spawn").Pool(processes, initializer=_init_worker, initargs=(am,))
+
+def map_replicates(pool, tasks):
+    if pool is None: return list(map(_run_replicate, tasks))
+    return pool.map(_run_replicate, tasks, chunksize=1)
+
+def run_replications(am, parameter_grid, n_replicates, simulate=simulate_market, seed=None, processes=None, common_random_numbers=False):
+    """
+    Runs n_replicates independent trajectories for every combination of parameter_grid across a process pool.
+    :param am: AgentManager shared read-only by all replicates
+    :param parameter_grid: dict of simulate keyword -> list of values, e.g. {"expected_buyer_arrivals": [50, 100]}
+    :param n_replicates: replicates per parameter combination
+    :param simulate: top-level function (am, rng, **parameters) -> dict of metrics
+    :param seed: entropy of the root SeedSequence; every replicate gets its own spawned Generator
+    :param processes: worker processes (all cores by default); 1 runs in this process
+    :param common_random_numbers: give replicate r of every combination the same random streams
+    :return: tidy DataFrame with one row per replicate: parameters, REPLICATE and the metrics
+    """
+    combinations = parameter_combinations(parameter_grid)
+    tasks = [
+        (simulate, parameters, replicate, replicate_seed)
+        for parameters, seeds in zip(combinations, replicate_seeds(seed, len(combinations), n_replicates, common_random_numbers))
+        for replicate, replicate_seed in enumerate(seeds)
+    ]
+    pool = worker_pool(am, processes)
+    if pool is None: return pd.DataFrame(map_replicates(pool, tasks))
+    with pool:
+        return pd.DataFrame(map_replicates(pool, tasks))
+
+def summarize_replications(results, parameters, confidence=0.95):
+    """
+    :param results: DataFrame from run_replications
+    :param parameters: the parameter columns to group replicates by
+    :return: tidy DataFrame with one row per parameter combination and metric: MEAN, STD, N, CI_LOW, CI_HIGH
+    """
+    metrics = [column for column in results.columns if column not in parameters and column != "REPLICATE"]
+    long = results.melt(id_vars=list(parameters) + ["REPLICATE"], value_vars=metrics, var_name="METRIC", value_name="VALUE")
+    summary = long.groupby(list(parameters) + ["METRIC"])["VALUE"].agg(MEAN="mean", STD="std", N="count").reset_index()
+    half_width = sp.stats.t.ppf((1 + confidence) / 2, summary["N"] - 1) * summary["STD"] / np.sqrt(summary["N"])
+    summary["CI_LOW"] = summary["MEAN"] - half_width
+    summary["CI_HIGH"] = summary["MEAN"] + half_width
+    return summary
@@ -0,0 +1,398 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import clearing_price
+from agent_manager import hyperbolic_discounting, quadrature_grid
+from agent_store import AgentStore, BUYER_COLUMNS, SELLER_COLUMNS
+from agent_records import DAYS_PER_YEAR, NEVER, to_days
+from histocompatibility import CompatibilityIndex
+from instrumentation import NULL_INSTRUMENTATION
+from regions import shard_rows
+from trajectory import ColumnWriter, read_table
+
+# columns the mortality models read, so the death step only copies those out of the stores
+BUYER_MORTALITY_COLUMNS = ["AGE", "IS_WHITE", "IS_BLACK", "IS_HISPANIC", "GFR", "HAS_DIABETES", "PRIOR_TRANSPLANT", "ENTRANCE_DAY", "TRANSPLANT_DAY"]
+SELLER_MORTALITY_COLUMNS = ["AGE", "IS_MALE", "MORTALITY_PREDICTOR", "TRANSPLANT_DAY"]
+
+# SIDE and EVENT codes of the streamed agent events
+BUYER, SELLER = 0, 1
+TRANSPLANT, DEATH = 1, 2
+EVENT_COLUMNS = ["AGENT_ID", "SOURCE_ROW", "REGION", "ENTRANCE_DAY", "AGE", "VALUATION", "PRICE"]
+# independent random streams of each source of randomness, so that changing one parameter (say the seller arrival
+# rate) leaves the draws of the others unchanged and runs with different parameters share common random numbers
+STREAMS = ["BUYER_ARRIVAL", "SELLER_ARRIVAL", "FEE", "CLEARING", "BUYER_DEATH", "SELLER_DEATH", "REGION"]
+
+class Simulator:
+    """
+    Discrete-time kidney market. Buyers (recipients) and sellers (givers) arrive as Poisson processes, value a
+    transplant by their discounted future income, trade at the clearing price and die according to the
+    AgentManager mortality models. All agent state lives in columnar AgentStores, so every phase of a step is a
+    handful of array operations over the whole population; event times are stored as day offsets from the start.
+    """
+    def __init__(
+            self,
+            am,
+            expected_buyer_arrivals,
+            expected_seller_arrivals,
+            time_step=1/12,
+            time_discounting=hyperbolic_discounting,
+            max_discounted_time=100,
+            buyer_fee=lambda rng, n : np.zeros(n),
+            seller_fee=lambda rng, n : np.zeros(n),
+            seller_transplant_mortality_fxn=lambda mort : mort,
+            seller_transplant_income_fxn=lambda inc : inc,
+            rng=None,
+            instrumentation=None,
+            valuation_cache=None,
+            valuation_scenario=(),
+            regions=None,
+            spillover=False,
+            clearing_threads=None,
+            compatibility_prefilter=False
+        ):
+        """
+        :param am: AgentManager the buyers and sellers are drawn from
+        :param expected_buyer_arrivals: expected number of buyers arriving per year
+        :param expected_seller_arrivals: expected number of sellers arriving per year
+        :param time_step: length of one step in years
+        :param time_discounting: vectorized discount factor as a function of future time
+        :param max_discounted_time: upper limit of the valuation integrals in years
+        :param buyer_fee: fees and costs each buyer pays to transplant, as a function of (rng, number of buyers); they
+            lower the most a buyer bids
+        :param seller_fee: fees and costs each seller pays to transplant, as a function of (rng, number of sellers);
+            they raise the least a seller asks, and negative fees are payments to sellers
+        :param seller_transplant_mortality_fxn: vectorized adjustment of a seller's mortality after giving a kidney
+        :param seller_transplant_income_fxn: vectorized adjustment of a seller's income after giving a kidney
+        :param rng: numpy.random.Generator the random streams of arrivals, fees, rationing and deaths are spawned from
+        :param instrumentation: instrumentation.Instrumentation recording per-phase times and counts of each step;
+            None turns it off
+        :param valuation_cache: valuation_cache.ValuationCache to reuse valuations from, possibly across simulations
+        :param valuation_scenario: hashable description of time_discounting and the seller transplant functions,
+            so that a shared valuation_cache only reuses valuations of the same scenario
+        :param regions: regions.RegionTable sharding the market: buyers and sellers only trade within their region,
+            each region at its own clearing price; None clears one national market
+        :param spillover: after the regional markets clear, the agents left searching in every region clear once
+            more in one national market
+        :param clearing_threads: threads clearing the regional markets concurrently (ThreadPoolExecutor's default by
+            default); 1 clears them one after another
+        :param compatibility_prefilter: keep buyers without a single ABO-compatible seller in their market out of its
+            clearing. This is a prefilter, not a compatibility constraint: the remaining buyers clear against every
+            seller of their market, so a trade may still pair a buyer with an ABO-incompatible seller, and HLA
+            antigens and cPRA are not considered at all (buyers carry no unacceptable antigens). Sellers drawn from
+            NHIS are untyped (BLOOD_TYPE 0) and compatible with every buyer, so it only restricts markets whose
+            sellers carry blood types
+        """
+        self.am = am
+        self.expected_buyer_arrivals = expected_buyer_arrivals
+        self.expected_seller_arrivals = expected_seller_arrivals
+        self.time_step = time_step
+        self.time_discounting = time_discounting
+        self.max_discounted_time = max_discounted_time
+        self.buyer_fee = buyer_fee
+        self.seller_fee = seller_fee
+        self.seller_transplant_mortality_fxn = seller_transplant_mortality_fxn
+        self.seller_transplant_income_fxn = seller_transplant_income_fxn
+        self.rng = np.random.default_rng() if rng is None else rng
+        self.streams = dict(zip(STREAMS, self.rng.spawn(len(STREAMS))))
+        self.instrumentation = NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+        self.quadrature_nodes = quadrature_grid(max_discounted_time)[0].size
+        self.valuation_cache = valuation_cache
+        self.valuation_scenario = (valuation_scenario, max_discounted_time)
+        self.regions = regions
+        self.spillover = spillover
+        self.clearing_threads = clearing_threads
+        self.compatibility_prefilter = compatibility_prefilter
+        # one rationing stream per region, so that the outcome does not depend on the order the threads finish in
+        self.region_streams = [] if regions is None else self.streams["CLEARING"].spawn(regions.n_regions)
+        self.clearing_pool = None # ThreadPoolExecutor of the regional markets while run is running
+
+        self.buyers = AgentStore(BUYER_COLUMNS)
+        self.sellers = AgentStore(SELLER_COLUMNS)
+        self.time = 0.
+        self.steps = 0
+        self.agents = 0 # agents that have arrived, the AGENT_ID of the next one
+        self.history = []
+        self.output = None # ColumnWriters of the steps and events tables while run streams its output
+
+    @property
+    def day(self):
+        return int(to_days(self.time))
+
+    def arrive(self):
+        arrival_rng = self.streams["BUYER_ARRIVAL"]
+        new_buyers = self.am.generate_recipients(arrival_rng.poisson(self.expected_buyer_arrivals*self.time_step), arrival_rng)
+        self.admit(self.buyers, new_buyers, "BUYER_DEATH", ENTRANCE_DAY=self.day)
+        arrival_rng = self.streams["SELLER_ARRIVAL"]
+        new_sellers = self.am.generate_givers(arrival_rng.poisson(self.expected_seller_arrivals*self.time_step), arrival_rng)
+        self.admit(self.sellers, new_sellers, "SELLER_DEATH", ENTRANCE_DAY=self.day)
+        self.instrumentation.count("ARRIVING_BUYERS", len(new_buyers["SOURCE_ROW"]))
+        self.instrumentation.count("ARRIVING_SELLERS", len(new_sellers["SOURCE_ROW"]))
+
+    def admit(self, store, cohort, death_stream, **fields):
+        # appends arriving agents with their AGENT_ID, location and the hazard they die at, an Exp(1) draw from the
+        # side's death stream, so that the k-th arrival of a side gets the same draw in every run of a seed
+        return store.append(
+            cohort, AGENT_ID=self.agent_ids(cohort), BIRTH_DAY=self.day - to_days(cohort["AGE"]),
+            DEATH_HAZARD=self.streams[death_stream].exponential(size=len(cohort["SOURCE_ROW"])), **self.locate(cohort), **fields
+        )
+
+    def agent_ids(self, cohort):
+        n = len(cohort["SOURCE_ROW"])
+        self.agents += n
+        return np.arange(self.agents - n, self.agents)
+
+    def locate(self, cohort):
+        # ZIP and REGION of arriving agents: the region of their zip code, or a zip code drawn from the region table
+        if self.regions is None: return {}
+        if "ZIP" in cohort: return {"REGION": self.regions.region_of(cohort["ZIP"])}
+        zips, regions = self.regions.draw(self.streams["REGION"], len(cohort["SOURCE_ROW"]))
+        return {"ZIP": zips, "REGION": regions}
+
+    def value(self, searching_buyers, searching_sellers):
+        # integrate income * mortality * time_discounting for every agent still searching
+        buyers = self.buyers.select(searching_buyers)
+        sellers = self.sellers.select(searching_sellers)
+        waitlist_time = (self.day-buyers["ENTRANCE_DAY"])/DAYS_PER_YEAR
+        buyer_kwargs = {"time_discounting": self.time_discounting, "max_discounted_time": self.max_discounted_time}
+        seller_kwargs = {"transplant_income_fxn": self.seller_transplant_income_fxn, "transplant_mortality_fxn": self.seller_transplant_mortality_fxn, **buyer_kwargs}
+        if self.valuation_cache is None:
+            buyer_values = self.am.value_recipients(buyers, waitlist_time=waitlist_time, **buyer_kwargs)
+            seller_values = self.am.value_givers(sellers, **seller_kwargs)
+            integrated = np.count_nonzero(searching_buyers) + np.count_nonzero(searching_sellers)
+        else:
+            computed = self.valuation_cache.computed
+            buyer_values = self.valuation_cache.value_recipients(self.am, buyers, waitlist_time, self.valuation_scenario, **buyer_kwargs)
+            seller_values = self.valuation_cache.value_givers(self.am, sellers, self.valuation_scenario, **seller_kwargs)
+            integrated = self.valuation_cache.computed - computed
+        self.buyers["VALUATION"][searching_buyers] = buyer_values - self.buyer_fee(self.streams["FEE"], np.count_nonzero(searching_buyers))
+        # a seller's VALUATION is the price it asks, so the fees it has to pay out of the price are added to it
+        self.sellers["VALUATION"][searching_sellers] = seller_values + self.seller_fee(self.streams["FEE"], np.count_nonzero(searching_sellers))
+        # integrand evaluations of both valuation integrals on the shared quadrature grid
+        self.instrumentation.count("INTEGRAND_EVALUATIONS", 2*self.quadrature_nodes*int(integrated))
+
+    def clear_rows(self, buyer_rows, seller_rows, rng, buyer_values=None, seller_values=None):
+        # the rows of the buyers and sellers trading in one market at its median clearing price; ties are rationed at
+        # random. The valuations of the rows are read from the stores unless given
+        buyer_values = self.buyers["VALUATION"][buyer_rows] if buyer_values is None else buyer_values
+        seller_values = self.sellers["VALUATION"][seller_rows] if seller_values is None else seller_values
+        if self.compatibility_prefilter and buyer_rows.size > 0 and seller_rows.size > 0:
+            index = CompatibilityIndex(self.sellers["BLOOD_TYPE"][seller_rows], self.sellers["HLA"][seller_rows])
+            compatible = index.compatible_counts(self.buyers["BLOOD_TYPE"][buyer_rows]) > 0
+            buyer_rows, buyer_values = buyer_rows[compatible], buyer_values[compatible]
+        result = clearing_price.clear_market(buyer_values, seller_values, rng=rng)
+        if result is None: return None
+        price, _, buyer_allocation, seller_allocation = result
+        return price, buyer_rows[buyer_allocation], seller_rows[seller_allocation]
+
+    def trade(self, price, successful_buyers, successful_sellers):
+        self.buyers["TRANSPLANT_DAY"][successful_buyers] = self.day
+        self.buyers["PRICE"][successful_buyers] = price
+        self.sellers["TRANSPLANT_DAY"][successful_sellers] = self.day
+        self.sellers["PRICE"][successful_sellers] = price
+        self.record_events(self.buyers, BUYER, successful_buyers, TRANSPLANT)
+        self.record_events(self.sellers, SELLER, successful_sellers, TRANSPLANT)
+
+    def clear(self, searching_buyers, searching_sellers):
+        """
+        Makes all possible deals at the median clearing price of the national market or, if the market is
+        sharded, of each region. Regions only read the stores while they clear, so they are cleared concurrently
+        and their trades written afterwards.
+        :return: (mean price of the deals, number of deals, number of deals made in the spillover market)
+        """
+        buyer_rows = np.flatnonzero(searching_buyers)
+        seller_rows = np.flatnonzero(searching_sellers)
+        if self.regions is None:
+            results = [self.clear_rows(buyer_rows, seller_rows, self.streams["CLEARING"])]
+        else:
+            # the rows of each side are sorted by region once and their valuations gathered in that order, so every
+            # regional market clears contiguous slices of them
+            buyer_rows, buyer_bounds = shard_rows(self.buyers["REGION"], buyer_rows, self.regions.n_regions)
+            seller_rows, seller_bounds = shard_rows(self.sellers["REGION"], seller_rows, self.regions.n_regions)
+            buyer_values = self.buyers["VALUATION"][buyer_rows]
+            seller_values = self.sellers["VALUATION"][seller_rows]
+            def clear_region(region):
+                buyers = slice(buyer_bounds[region], buyer_bounds[region+1])
+                sellers = slice(seller_bounds[region], seller_bounds[region+1])
+                return self.clear_rows(buyer_rows[buyers], seller_rows[sellers], self.region_streams[region], buyer_values[buyers], seller_values[sellers])
+            mapper = map if self.clearing_pool is None else self.clearing_pool.map
+            results = list(mapper(clear_region, range(self.regions.n_regions)))
+        results = [result for result in results if result is not None]
+        for result in results: self.trade(*result)
+
+        spillover = 0
+        if self.regions is not None and self.spillover:
+            # the agents no regional market could match, pooled nationally
+            searching_buyers = searching_buyers & (self.buyers["TRANSPLANT_DAY"] == NEVER)
+            searching_sellers = searching_sellers & (self.sellers["TRANSPLANT_DAY"] == NEVER)
+            result = self.clear_rows(np.flatnonzero(searching_buyers), np.flatnonzero(searching_sellers), self.streams["CLEARING"])
+            if result is not None:
+                self.trade(*result)
+                results.append(result)
+                spillover = result[1].size
+
+        if not results: return None, 0, 0
+        transplants = np.array([result[1].size for result in results])
+        prices = np.array([result[0] for result in results])
+        price = np.average(prices, weights=transplants) if transplants.sum() > 0 else prices.mean()
+        return price, int(transplants.sum()), spillover
+
+    def buyer_mortality(self, living):
+        transplanted = self.buyers["TRANSPLANT_DAY"][living] != NEVER
+        mort = np.empty(living.size)
+        buyers = self.buyers.select(living[transplanted], BUYER_MORTALITY_COLUMNS)
+        mort[transplanted] = self.am.recipient_mortality_transplant(buyers, (buyers["TRANSPLANT_DAY"]-buyers["ENTRANCE_DAY"])/DAYS_PER_YEAR, buyers["AGE"])
+        buyers = self.buyers.select(living[~transplanted], BUYER_MORTALITY_COLUMNS)
+        mort[~transplanted] = self.am.receipient_mortality_dialysis(buyers, buyers["AGE"])
+        return mort
+
+    def seller_mortality(self, living):
+        sellers = self.sellers.select(living, SELLER_MORTALITY_COLUMNS)
+        mort = self.am.giver_mortality(sellers, sellers["AGE"])
+        transplanted = sellers["TRANSPLANT_DAY"] != NEVER
+        mort[transplanted] = self.seller_transplant_mortality_fxn(mort[transplanted])
+        return mort
+
+    def die(self):
+        # the annual mortality of each living agent, converted to the length of a step, adds -log(1 - mort)*time_step
+        # to its cumulative hazard and the agent dies once that reaches its DEATH_HAZARD. As the threshold is Exp(1),
+        # an agent alive at the start of a step dies in it with probability 1 - (1 - mort)**time_step, as with one
+        # Bernoulli draw per step; but the randomness belongs to the agent instead of a store row, so runs with common
+        # random numbers stay paired after their deaths diverge and streamed runs, whose stores are compacted, equal
+        # runs kept in memory
+        deaths = 0
+        for store, side, mortality in [(self.buyers, BUYER, self.buyer_mortality), (self.sellers, SELLER, self.seller_mortality)]:
+            living = np.flatnonzero(store["DEATH_DAY"] == NEVER)
+            mort = np.clip(mortality(living), 0, 1)
+            with np.errstate(divide="ignore"):
+                hazard = store["CUMULATIVE_HAZARD"][living] - np.log1p(-mort)*self.time_step
+            store["CUMULATIVE_HAZARD"][living] = hazard
+            dying = living[hazard >= store["DEATH_HAZARD"][living]]
+            store["DEATH_DAY"][dying] = self.day
+            self.record_events(store, side, dying, DEATH)
+            deaths += dying.size
+        return deaths
+
+    def step(self):
+        self.instrumentation.start_step(self.steps, self.time)
+
+        # update ages of all living buyers and sellers from their integer birth days, instead of adding time_step to
+        # the float32 ages every step
+        with self.instrumentation.phase("AGING"):
+            for store in [self.buyers, self.sellers]:
+                living = store["DEATH_DAY"] == NEVER
+                store["AGE"][living] = (self.day - store["BIRTH_DAY"][living]) / DAYS_PER_YEAR
+
+        # a poisson distribution number of buyers and sellers arrive
+        with self.instrumentation.phase("ARRIVAL"):
+            self.arrive()
+
+        # value and clear the market among the buyers and sellers that haven't yet transplanted or died
+        searching_buyers = (self.buyers["TRANSPLANT_DAY"] == NEVER) & (self.buyers["DEATH_DAY"] == NEVER)
+        searching_sellers = (self.sellers["TRANSPLANT_DAY"] == NEVER) & (self.sellers["DEATH_DAY"] == NEVER)
+        with self.instrumentation.phase("VALUATION"):
+            self.value(searching_buyers, searching_sellers)
+        with self.instrumentation.phase("CLEARING"):
+            price, transplants, spillover_transplants = self.clear(searching_buyers, searching_sellers)
+
+        # kill off buyers and sellers according to mortality rate
+        with self.instrumentation.phase("MORTALITY"):
+            deaths = self.die()
+
+        aggregates = {
+            "TIME": self.time,
+            "SEARCHING_BUYERS": np.count_nonzero(searching_buyers),
+            "SEARCHING_SELLERS": np.count_nonzero(searching_sellers),
+            "TRANSPLANTS": transplants,
+            "SPILLOVER_TRANSPLANTS": spillover_transplants,
+            "PRICE": np.nan if price is None else price,
+            "DEATHS": deaths,
+        }
+        if self.output is None: self.history.append(aggregates)
+        else:
+            self.output["steps"].write(aggregates)
+            # the dead are fully described by their streamed events, so they no longer take up memory
+            for store in [self.buyers, self.sellers]:
+                store.compact(store["DEATH_DAY"] == NEVER)
+        self.instrumentation.end_step(BUYERS=len(self.buyers), SELLERS=len(self.sellers), **aggregates)
+        self.time += self.time_step
+        self.steps += 1
+
+    def record_events(self, store, side, rows, event):
+        if self.output is None or rows.size == 0: return
+        self.output["events"].write({
+            "SIDE": np.full(rows.size, side, dtype=np.int8),
+            "EVENT": np.full(rows.size, event, dtype=np.int8),
+            "DAY": np.full(rows.size, self.day, dtype=np.int32),
+            **{column: store[column][rows] for column in EVENT_COLUMNS},
+        })
+
+    def save_checkpoint(self, path):
+        # everything but the AgentManager and the model functions, written atomically
+        if self.output is not None:
+            for writer in self.output.values(): writer.flush()
+        state = {
+            "buyers": self.buyers,
+            "sellers": self.sellers,
+            "streams": {name: stream.bit_generator.state for name, stream in self.streams.items()},
+            "region_streams": [stream.bit_generator.state for stream in self.region_streams],
+            "time": self.time,
+            "steps": self.steps,
+            "agents": self.agents,
+            "history": self.history,
+            "output_rows": None if self.output is None else {name: len(writer) for name, writer in self.output.items()},
+        }
+        with open(path + ".tmp", "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def load_checkpoint(self, path):
+        # restores a checkpoint into a Simulator constructed with the same parameters; output written after it is discarded
+        with open(path, "rb") as file:
+            state = pickle.load(file)
+        self.buyers = state["buyers"]
+        self.sellers = state["sellers"]
+        for name, stream in self.streams.items(): stream.bit_generator.state = state["streams"][name]
+        for stream, stream_state in zip(self.region_streams, state.get("region_streams", [])): stream.bit_generator.state = stream_state
+        self.time = state["time"]
+        self.steps = state["steps"]
+        self.agents = state["agents"]
+        self.history = state["history"]
+        if self.output is not None:
+            for name, writer in self.output.items():
+                writer.truncate((state["output_rows"] or {}).get(name, 0))
+
+    def run(self, time_horizon, output_dir=None, checkpoint_path=None, checkpoint_interval=1):
+        """
+        :param time_horizon: how many years since its start the simulation should last
+        :param output_dir: directory to stream the per-step aggregates (output_dir/steps) and the transplant and death
+            events of agents (output_dir/events) to as trajectory tables, instead of keeping them in memory
+        :param checkpoint_path: file the simulation state is saved to every checkpoint_interval years; if it already
+            exists the run resumes from it
+        :param checkpoint_interval: years between checkpoints
+        :return: DataFrame with one row of market aggregates per step
+        """
+        if output_dir is not None:
+            self.output = {name: ColumnWriter(os.path.join(output_dir, name)) for name in ["steps", "events"]}
+        if checkpoint_path is not None and os.path.exists(checkpoint_path):
+            self.load_checkpoint(checkpoint_path)
+        elif self.output is not None:
+            # a fresh run replaces the output of earlier runs
+            for writer in self.output.values(): writer.truncate(0)
+        steps_per_checkpoint = max(1, int(round(checkpoint_interval/self.time_step)))
+        total_steps = int(round(time_horizon/self.time_step))
+        if self.regions is not None and self.regions.n_regions > 1 and self.clearing_threads != 1:
+            self.clearing_pool = ThreadPoolExecutor(self.clearing_threads)
+        try:
+            while self.steps < total_steps:
+                self.step()
+                if checkpoint_path is not None and (self.steps % steps_per_checkpoint == 0 or self.steps == total_steps):
+                    self.save_checkpoint(checkpoint_path)
+        finally:
+            if self.clearing_pool is not None: self.clearing_pool.shutdown()
+            self.clearing_pool = None
+        if self.output is None: return pd.DataFrame(self.history)
+        for writer in self.output.values(): writer.close()
+        self.output = None
+        return read_table(os.path.join(output_dir, "steps"))
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import scipy as sp
+from replication import simulate_market, parameter_combinations, replicate_seeds, worker_pool, map_replicates
+
+def half_width(values, confidence=0.95):
+    # half-width of the t confidence interval of the mean, ignoring NaNs (e.g. MEAN_PRICE of a run without trades)
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    if values.size < 2: return np.inf
+    return sp.stats.t.ppf((1 + confidence) / 2, values.size - 1) * np.std(values, ddof=1) / np.sqrt(values.size)
+
+def required_replicates(rows, targets, relative, confidence):
+    """
+    :return: (ratio of the widest interval to its target, replicates the point needs in total to meet every target)
+    """
+    ratio = 0
+    for metric, target in targets.items():
+        values = np.array([row[metric] for row in rows], dtype=float)
+        if relative: target = target * abs(np.nanmean(values)) if np.any(~np.isnan(values)) else 0
+        width = half_width(values, confidence)
+        if width == 0: continue
+        ratio = max(ratio, width / target if target > 0 else np.inf)
+    # half-widths shrink with the square root of the number of replicates
+    return ratio, len(rows) * ratio**2
+
+def run_sweep(
+        am,
+        parameter_grid,
+        targets,
+        simulate=simulate_market,
+        relative=False,
+        confidence=0.95,
+        min_replicates=5,
+        max_replicates=100,
+        batch_replicates=None,
+        max_total_replicates=None,
+        seed=None,
+        processes=None,
+        verbose=False
+    ):
+    """
+    Sweeps every combination of parameter_grid with common random numbers (replicate r of every combination runs on
+    the same random streams) and adaptive stopping: after min_replicates, a combination only gets more replicates
+    while the confidence interval of one of the target metrics is wider than its target, and the combinations
+    furthest from their targets are served first.
+    :param am: AgentManager shared read-only by all replicates
+    :param parameter_grid: dict of simulate keyword -> list of values, e.g. {"buyer_fee_mean": [0, 1000, 5000]}
+    :param targets: dict of metric -> largest acceptable confidence interval half-width, e.g. {"TRANSPLANTS": 5}
+    :param simulate: top-level function (am, rng, **parameters) -> dict of metrics
+    :param relative: targets are fractions of the absolute mean of the metric instead of absolute half-widths
+    :param confidence: confidence level of the intervals
+    :param min_replicates: replicates every combination starts with
+    :param max_replicates: most replicates of one combination
+    :param batch_replicates: most replicates added to one combination per round (min_replicates by default)
+    :param max_total_replicates: budget of replicates over the whole sweep
+    :param seed: entropy of the root SeedSequence
+    :param processes: worker processes (all cores by default); 1 runs in this process
+    :return: tidy DataFrame with one row per replicate (as run_replications), plus CONVERGED per combination
+    """
+    if batch_replicates is None: batch_replicates = min_replicates
+    combinations = parameter_combinations(parameter_grid)
+    seeds = replicate_seeds(seed, 1, max_replicates, common_random_numbers=True)[0]
+    rows = [[] for _ in combinations]
+    converged = [False] * len(combinations)
+    pending = {i: min(min_replicates, max_replicates) for i in range(len(combinations))}
+    total = 0
+
+    pool = worker_pool(am, processes)
+    try:
+        while pending:
+            indices = [i for i, count in pending.items() for _ in range(count)]
+            tasks = [
+                (simulate, combinations[i], replicate, seeds[replicate])
+                for i, count in pending.items()
+                for replicate in range(len(rows[i]), len(rows[i]) + count)
+            ]
+            for i, row in zip(indices, map_replicates(pool, tasks)):
+                rows[i].append(row)
+            total += len(tasks)
+
+            # the replicates each unconverged combination still needs, widest intervals first
+            needs = []
+            for i in range(len(combinations)):
+                ratio, required = required_replicates(rows[i], targets, relative, confidence)
+                converged[i] = ratio <= 1
+                if not converged[i] and len(rows[i]) < max_replicates:
+                    needed = np.ceil(required) - len(rows[i]) if np.isfinite(required) else batch_replicates
+                    needs.append((ratio, i, int(np.clip(needed, 1, min(batch_replicates, max_replicates - len(rows[i]))))))
+            needs.sort(reverse=True)
+            pending = {}
+            budget = np.inf if max_total_replicates is None else max_total_replicates - total
+            for ratio, i, needed in needs:
+                if budget <= 0: break
+                pending[i] = int(min(needed, budget))
+                budget -= pending[i]
+            if verbose: print(f"{total} replicates run, {sum(converged)}/{len(combinations)} combinations converged")
+    finally:
+        if pool is not None: pool.close()
+
+    results = pd.DataFrame([row for combination_rows in rows for row in combination_rows])
+    results["CONVERGED"] = np.repeat(converged, [len(combination_rows) for combination_rows in rows])
+    return results
+
+def paired_differences(results, parameters, baseline, confidence=0.95):
+    """
+    Differences of every combination's metrics from a baseline combination, paired by REPLICATE. With common random
+    numbers the paired differences vary far less than the metrics themselves.
+    :param results: DataFrame from run_sweep (or run_replications with common_random_numbers=True)
+    :param parameters: the parameter columns identifying a combination
+    :param baseline: dict of parameter -> value of the baseline combination
+    :return: tidy DataFrame with one row per combination and metric: MEAN, STD, N, CI_LOW, CI_HIGH of the difference
+    """
+    parameters = list(parameters)
+    metrics = [column for column in results.columns if column not in parameters + ["REPLICATE", "CONVERGED"]]
+    is_baseline = np.logical_and.reduce([results[parameter] == value for parameter, value in baseline.items()])
+    base = results[is_baseline].set_index("REPLICATE")[metrics]
+    paired = results.join(base, on="REPLICATE", rsuffix="_BASELINE", how="inner")
+    for metric in metrics:
+        paired[metric] = paired[metric] - paired[metric + "_BASELINE"]
+    long = paired.melt(id_vars=parameters + ["REPLICATE"], value_vars=metrics, var_name="METRIC", value_name="DIFFERENCE")
+    summary = long.groupby(parameters + ["METRIC"])["DIFFERENCE"].agg(MEAN="mean", STD="std", N="count").reset_index()
+    half_widths = sp.stats.t.ppf((1 + confidence) / 2, summary["N"] - 1) * summary["STD"] / np.sqrt(summary["N"])
+    summary["CI_LOW"] = summary["MEAN"] - half_widths
+    summary["CI_HIGH"] = summary["MEAN"] + half_widths
+    return summary
@@ -0,0 +1,139 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import clearing_price
+from agent_manager import AgentManager
+from benchmarks import synthetic_tables
+from simulator import Simulator
+
+# Checks of the market's numerical invariants on the synthetic tables of benchmarks.py. Run with
+# `python -m pytest test_market.py` from transplant_market/.
+
+@pytest.fixture(scope="module")
+def am():
+    return AgentManager.from_tables(*synthetic_tables(n_recipients=2000, n_givers=4000))
+
+def market_simulator(am, seed=3, **simulator_kwargs):
+    # a small market in which sellers are paid (a negative fee) enough that trades happen
+    simulator_kwargs = {
+        "buyer_fee": lambda rng, n : rng.normal(0, 3e5, n),
+        "seller_fee": lambda rng, n : rng.normal(-1e6, 3e5, n),
+        **simulator_kwargs
+    }
+    return Simulator(am, 300, 400, rng=np.random.default_rng(seed), **simulator_kwargs)
+
+@pytest.mark.parametrize("kind", ["recipient", "giver"])
+def test_batch_valuation_matches_quad(am, kind):
+    rng = np.random.default_rng(0)
+    agents = am.generate_recipients(50, rng) if kind == "recipient" else am.generate_givers(50, rng)
+    assert am.validate_valuations(agents, kind=kind, sample_size=5, seed=0) < 1e-3
+    if kind == "giver":
+        # the default check of givers compares non-zero valuations
+        assert np.all(np.abs(am.value_givers(agents, transplant_income_fxn=lambda inc : 0.9 * inc)) > 0)
+
+def random_market(rng, n, ties=False):
+    buyers = rng.normal(1, 1, n)
+    sellers = rng.normal(0, 1, n)
+    if ties: buyers, sellers = np.round(buyers, 1), np.round(sellers, 1)
+    return buyers, sellers
+
+@pytest.mark.parametrize("ties", [False, True])
+def test_clearing_interval_balances_the_market(ties):
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        buyers, sellers = random_market(rng, rng.integers(1, 40), ties)
+        interval = clearing_price.find_clearing_interval(buyers, sellers)
+        if interval is None:
+            assert buyers.max() < sellers.min()
+            continue
+        assert interval.min_bound <= interval.max_bound
+        price = (interval.min_bound + interval.max_bound) / 2
+        excess = clearing_price.excess_demand(np.sort(buyers), np.sort(sellers), price)
+        assert excess == 0 or not interval.exact
+        if not ties and interval.exact:
+            # the binary search agrees with the order-statistic solver on markets without ties
+            assert clearing_price.find_clearing_price(buyers, sellers, "binary") == clearing_price.find_clearing_price(buyers, sellers, "sweep")
+
+@pytest.mark.parametrize("rationing", ["random", "pro-rata"])
+def test_clear_market_trades_equal_quantities_at_the_price(rationing):
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        buyers, sellers = random_market(rng, rng.integers(1, 40), ties=True)
+        result = clearing_price.clear_market(buyers, sellers, rationing=rationing, rng=rng)
+        if result is None: continue
+        price, _, buyer_allocation, seller_allocation = result
+        buyer_allocation, seller_allocation = np.asarray(buyer_allocation, dtype=float), np.asarray(seller_allocation, dtype=float)
+        assert buyer_allocation.sum() == pytest.approx(seller_allocation.sum())
+        assert np.all(buyers[buyer_allocation > 0] >= price) and np.all(sellers[seller_allocation > 0] <= price)
+        # every agent strictly better off trading trades in full
+        assert np.all(buyer_allocation[buyers > price] == 1) and np.all(seller_allocation[sellers < price] == 1)
+
+def test_sorted_values_stay_sorted():
+    rng = np.random.default_rng(3)
+    values = clearing_price.SortedValues(4)
+    reference = []
+    for _ in range(500):
+        operation = rng.integers(6)
+        if operation == 0:
+            value = float(rng.integers(20))
+            values.insert(value)
+            reference.append(value)
+        elif operation == 1:
+            new = rng.integers(0, 20, rng.integers(0, 10)).astype(float)
+            values.insert_many(new)
+            reference.extend(new.tolist())
+        elif operation == 2 and reference:
+            value = reference[rng.integers(len(reference))]
+            values.remove(value)
+            reference.remove(value)
+        elif operation == 3 and reference:
+            count = int(rng.integers(1, len(reference) + 1))
+            assert values.pop_first(count).tolist() == sorted(reference)[:count]
+            reference = sorted(reference)[count:]
+        elif operation == 4 and reference:
+            count = int(rng.integers(1, len(reference) + 1))
+            assert values.pop_last(count).tolist() == sorted(reference)[len(reference)-count:]
+            reference = sorted(reference)[:len(reference)-count]
+        assert values.values.tolist() == sorted(reference)
+
+def test_order_book_clears_like_clear_market():
+    rng = np.random.default_rng(4)
+    for _ in range(100):
+        buyers, sellers = random_market(rng, rng.integers(1, 40))
+        book = clearing_price.OrderBook(buyers, sellers)
+        result = book.clear()
+        expected = clearing_price.clear_market(buyers, sellers, rng=rng)
+        if expected is None:
+            assert result is None
+            continue
+        price, traded_buyers, traded_sellers = result
+        assert price == pytest.approx(expected[0])
+        assert sorted(traded_buyers.tolist()) == sorted(buyers[expected[2]].tolist())
+        assert sorted(traded_sellers.tolist()) == sorted(sellers[expected[3]].tolist())
+        assert len(book.buyers) == buyers.size - traded_buyers.size
+
+def test_resumed_run_matches_uninterrupted_run(am, tmp_path):
+    checkpoint_path = os.path.join(tmp_path, "checkpoint.pkl")
+    expected = market_simulator(am).run(2)
+    market_simulator(am).run(1, checkpoint_path=checkpoint_path)
+    resumed = market_simulator(am, seed=99).run(2, checkpoint_path=checkpoint_path)
+    assert expected["TRANSPLANTS"].sum() > 0
+    pd.testing.assert_frame_equal(resumed, expected)
+
+def test_streamed_run_matches_run_in_memory(am, tmp_path):
+    # streaming compacts the dead out of the stores, which must not change who dies when
+    in_memory = market_simulator(am).run(3)
+    streamed = market_simulator(am).run(3, output_dir=os.path.join(tmp_path, "output"))
+    assert in_memory["DEATHS"].sum() > 0
+    pd.testing.assert_frame_equal(streamed, in_memory)
+
+def test_fees_lower_bids_and_raise_asks(am):
+    valuations = {}
+    for fee in [0, 1000]:
+        simulation = market_simulator(am, buyer_fee=lambda rng, n : np.full(n, fee), seller_fee=lambda rng, n : np.full(n, fee))
+        simulation.arrive()
+        simulation.value(np.ones(len(simulation.buyers), dtype=bool), np.ones(len(simulation.sellers), dtype=bool))
+        valuations[fee] = simulation.buyers["VALUATION"].copy(), simulation.sellers["VALUATION"].copy()
+    np.testing.assert_allclose(valuations[1000][0], valuations[0][0] - 1000)
+    np.testing.assert_allclose(valuations[1000][1], valuations[0][1] + 1000)
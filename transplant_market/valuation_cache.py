@@ -0,0 +1,101 @@
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from agent_manager import RECIPIENT_COLUMNS, GIVER_COLUMNS
+
+class ValuationCache:
+    """
+    Bounded LRU cache of batch valuations. Agents drawn from the same KIDPAN/NHIS row share every covariate but
+    age, so a valuation is keyed on (scenario, kind, source row, age bucket, waitlist bucket) and computed once per
+    key, at the midpoint of its buckets, for all agents that fall into it. Coarser buckets trade accuracy for hits:
+    with yearly buckets an agent's valuation is reused for eleven of every twelve monthly steps.
+    """
+    def __init__(self, max_entries=1000000, age_step=1, waitlist_step=1):
+        """
+        :param max_entries: valuations kept before the least recently used ones are evicted
+        :param age_step: width of the age buckets in years
+        :param waitlist_step: width of the waitlist time buckets in years
+        """
+        self.max_entries = max_entries
+        self.age_step = age_step
+        self.waitlist_step = waitlist_step
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.computed = 0 # valuations integrated, one per missing key
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"HITS": self.hits, "MISSES": self.misses, "EVICTIONS": self.evictions, "ENTRIES": len(self.entries), "HIT_RATE": self.hits / lookups if lookups else np.nan}
+
+    def profiles(self, agents, columns):
+        # the source row of each agent, or a hash of its age-independent covariates if it was not drawn from a table
+        if "SOURCE_ROW" in agents: return np.asarray(agents["SOURCE_ROW"], dtype=np.int64)
+        # KIDPAN rows carry EDUCATION, from which the EDUC covariate is derived
+        covariates = pd.DataFrame({column: np.asarray(agents[column]) for column in columns + ["EDUCATION"] if column in agents and column != "AGE"})
+        return pd.util.hash_pandas_object(covariates, index=False).to_numpy().view(np.int64)
+
+    def value(self, kind, agents, ages, waitlist_time, compute, scenario):
+        """
+        :param kind: which valuation the key belongs to, e.g. "recipient"
+        :param agents: struct-of-arrays cohort
+        :param ages: age of each agent
+        :param waitlist_time: years each agent has waited, scalar or one per agent
+        :param compute: function (cohort of one agent per missing key, ages, waitlist times) -> valuations
+        :param scenario: hashable description of everything else the valuation depends on
+        :return: cached or newly computed valuation of each agent
+        """
+        columns = RECIPIENT_COLUMNS if kind == "recipient" else GIVER_COLUMNS
+        n = len(ages)
+        # the tolerance keeps float32 ages that have been aged month by month in the bucket they have reached
+        keys = np.column_stack([
+            self.profiles(agents, columns),
+            np.floor(np.asarray(ages, dtype=float) / self.age_step + 1e-4).astype(np.int64),
+            np.floor(np.broadcast_to(np.asarray(waitlist_time, dtype=float), n) / self.waitlist_step + 1e-4).astype(np.int64),
+        ])
+        unique_keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+        values = np.empty(len(unique_keys))
+        missing = []
+        for i, key in enumerate(map(tuple, unique_keys.tolist())):
+            key = (scenario, kind) + key
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                values[i] = self.entries[key]
+            else:
+                missing.append(i)
+        agents_per_key = np.bincount(inverse, minlength=len(unique_keys))
+        self.misses += int(agents_per_key[missing].sum())
+        self.hits += n - int(agents_per_key[missing].sum())
+
+        if missing:
+            missing = np.array(missing)
+            self.computed += missing.size
+            rows = first[missing]
+            cohort = {column: np.asarray(agents[column])[rows] for column in agents}
+            values[missing] = compute(cohort, (unique_keys[missing, 1] + 0.5) * self.age_step, (unique_keys[missing, 2] + 0.5) * self.waitlist_step)
+            for key, value in zip(map(tuple, unique_keys[missing].tolist()), values[missing].tolist()):
+                self.entries[(scenario, kind) + key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return values[inverse]
+
+    def value_recipients(self, am, agents, waitlist_time=0, scenario=(), **valuation_kwargs):
+        # AgentManager.value_recipients through the cache; valuation_kwargs must be the same whenever scenario is.
+        # Keys include the fingerprint of am's tables, as source rows of different managers are different agents
+        def compute(cohort, ages, waitlist_times):
+            cohort["AGE"] = ages
+            return am.value_recipients(cohort, waitlist_time=waitlist_times, **valuation_kwargs)
+        return self.value("recipient", agents, agents["AGE"], waitlist_time, compute, (am.fingerprint, scenario))
+
+    def value_givers(self, am, agents, scenario=(), **valuation_kwargs):
+        # AgentManager.value_givers through the cache; valuation_kwargs must be the same whenever scenario is
+        def compute(cohort, ages, waitlist_times):
+            cohort["AGE"] = ages
+            return am.value_givers(cohort, **valuation_kwargs)
+        return self.value("giver", agents, agents["AGE"], 0, compute, (am.fingerprint, scenario))